@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# Replays the bot's side of the workload: a burst of /request commands
+# (requests_since, Requests.create, add_request), /status and /history
+# lookups, the worker's scan of the queue, then completing everything the
+# way follow_events does after the payouts are made. Prints one JSON
+# object per size.
+#
+#   python bench/bench_bot.py [--sizes 1000,10000] [--concurrency C] [--backend files|queue]
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sqlalchemy as sa
+
+import faucetrecent
+import faucetrequests
+
+from timestuff import totime, utcnow
+
+def fake_interaction(i : int):
+    user = types.SimpleNamespace(id=10**17 + i, name=f"user{i}", created_at=utcnow() - datetime.timedelta(days=365))
+    return types.SimpleNamespace(id=2 * 10**17 + i, guild_id=3 * 10**17, user=user)
+
+async def run(n : int, concurrency : int) -> dict:
+    os.makedirs(faucetrequests.CURRENT)
+    recent = faucetrecent.AsyncRecentDB()
+    requests = faucetrequests.open_requests()
+    statements = [0]
+    sa.event.listen(recent.db.engine, "before_cursor_execute", lambda *args: statements.__setitem__(0, statements[0] + 1))
+    timings = {}
+
+    async def request(i : int):
+        interaction = fake_interaction(i)
+        prev = await recent.requests_since(interaction.user.id, utcnow() - datetime.timedelta(hours=1))
+        if not prev and (reqd := requests.create(interaction, f"tb1qaddress{i}")):
+            await recent.add_request(faucetrecent.RecentReq(filename=reqd["filename"], timestamp=totime(reqd["timestamp"]), user_name=reqd["user_name"], user_id=reqd["user_id"], address=reqd["address"]))
+            return reqd["filename"]
+        return None
+
+    start = time.perf_counter()
+    filenames = []
+    for i in range(0, n, concurrency):
+        filenames.extend(f for f in await asyncio.gather(*(request(j) for j in range(i, min(n, i + concurrency)))) if f)
+    timings["request"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await asyncio.gather(*(recent.count_pending() for _ in range(100)))
+    timings["status_x100"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await asyncio.gather(*(recent.history(10**17 + i) for i in range(min(n, 100))))
+    timings["history_x100"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pending = len(requests.read())
+    timings["read"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    completed = 0
+    for i in range(0, len(filenames), 500):
+        chunk = filenames[i:i+500]
+        done = await asyncio.to_thread(requests.complete_many, chunk)
+        await recent.complete_requests([(f, "00" * 32) for f, ok in done.items() if ok])
+        completed += sum(done.values())
+    timings["complete"] = time.perf_counter() - start
+
+    return dict(bench="bot", backend=faucetrequests.BACKEND, requests=n, concurrency=concurrency, created=len(filenames), read=pending, completed=completed,
+                seconds={k: round(v, 4) for k, v in timings.items()},
+                requests_per_sec=round(len(filenames) / timings["request"]),
+                db_statements=statements[0],
+                peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,10000")
+    parser.add_argument("--concurrency", type=int, default=50, help="commands in flight at once")
+    parser.add_argument("--backend", default=faucetrequests.BACKEND, choices=["files", "queue"])
+    args = parser.parse_args()
+    faucetrequests.BACKEND = args.backend
+    logging.disable(logging.CRITICAL)
+    for n in [int(x) for x in args.sizes.split(",")]:
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            print(json.dumps(asyncio.run(run(n, args.concurrency))), flush=True)
+
+if __name__ == "__main__":
+    main()
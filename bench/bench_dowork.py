@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# Times payout.Worker.dowork against a fake bitcoind with N requests
+# queued, draining the queue and then running one more (idle) cycle, as
+# happens while the bot has yet to move the completed requests away.
+# Each size runs in its own process so peak RSS is per size. Prints one
+# JSON object per size.
+#
+#   python bench/bench_dowork.py [--sizes 1000,10000,100000] [--latency S] [--users U]
+
+import argparse
+import collections
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+class Phases:
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+
+    def wrap(self, obj, attr : str, name : str) -> None:
+        fn = getattr(obj, attr)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.seconds[name] += time.perf_counter() - start
+                self.calls[name] += 1
+        setattr(obj, attr, timed)
+
+    def result(self) -> dict:
+        return {k: dict(seconds=round(v, 4), calls=self.calls[k]) for k, v in sorted(self.seconds.items())}
+
+def run_one(n : int, latency : float, users : int) -> dict:
+    import sqlalchemy as sa
+
+    import bitcoinrpc
+    import faucetstatus
+    import payout
+
+    import fakerpc
+    import genrequests
+
+    os.makedirs("payouts")
+    with open("cookie", "w") as f:
+        f.write("__cookie__:fake\n")
+    fake = fakerpc.FakeBitcoind(latency=latency)
+    server = fakerpc.serve(fake)
+    port = server.server_address[1]
+
+    start = time.perf_counter()
+    genrequests.generate(n, users=users)
+    gen_seconds = time.perf_counter() - start
+
+    worker = payout.Worker()
+    worker.rpc = bitcoinrpc.RPC(port=port, cookie="cookie")
+    worker.fund_rpc = bitcoinrpc.RPC(port=port, cookie="cookie")
+    if worker.pool is not None:
+        worker.pool.rpc = worker.rpc
+
+    statements = [0]
+    sa.event.listen(worker.paid.engine, "before_cursor_execute", lambda *args: statements.__setitem__(0, statements[0] + 1))
+
+    phases = Phases()
+    phases.wrap(worker.reqs, "read", "scan")
+    phases.wrap(worker.paid, "seen_many", "seen")
+    phases.wrap(worker.paid, "claim_users", "claim")
+    phases.wrap(worker.paid, "add_bad_reqs", "db_bad")
+    phases.wrap(worker.paid, "add_paid_reqs", "db_paid")
+    phases.wrap(worker, "generate_payouts", "payout_rpc")
+    phases.wrap(worker, "get_balance", "balance")
+    phases.wrap(worker.events, "append", "events")
+    phases.wrap(faucetstatus.Status, "write", "status")
+
+    cycles = []
+    more_work = True
+    while more_work:
+        start = time.perf_counter()
+        more_work = worker.dowork()
+        cycles.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    worker.dowork()
+    idle = time.perf_counter() - start
+    server.shutdown()
+
+    return dict(bench="dowork", requests=n, users=users or n, rpc_latency=latency,
+                generate_seconds=round(gen_seconds, 4),
+                cycles=len(cycles), drain_seconds=round(sum(cycles), 4),
+                cycle_seconds=[round(c, 4) for c in cycles],
+                idle_cycle_seconds=round(idle, 4),
+                phases=phases.result(),
+                db_statements=statements[0],
+                rpc_calls=fake.calls,
+                peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each fake RPC call")
+    parser.add_argument("--users", type=int, default=0, help="number of distinct users (default: one per request)")
+    parser.add_argument("--one", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one is not None:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        logging.disable(logging.CRITICAL)
+        with tempfile.TemporaryDirectory() as d:
+            os.chdir(d)
+            print(json.dumps(run_one(args.one, args.latency, args.users)))
+        return
+
+    for n in [int(x) for x in args.sizes.split(",")]:
+        cmd = [sys.executable, os.path.abspath(__file__), "--one", str(n), "--latency", str(args.latency), "--users", str(args.users)]
+        sys.stdout.write(subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True).stdout)
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Insert throughput for 500-row payout batches into audit.sqlite: the old
+# per-object ORM add/refresh path on a default engine, against
+# PayoutDB.add_paid_reqs/add_bad_reqs.
+#
+#   python bench/bench_inserts.py [batches]
+
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlmodel import Session, SQLModel, create_engine
+
+import faucetpayouts
+
+BATCH = 500
+
+def make_reqs(batch : int):
+    t = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(hours=batch)
+    return [faucetpayouts.Request(filename=f"{batch}-{i}.json", timestamp=t, username=f"user{i}", userid=i, address=f"tb1q{batch:06d}{i:06d}")
+            for i in range(BATCH)]
+
+def legacy_paid(engine, now, txid, reqs):
+    with Session(engine) as session:
+        payout = faucetpayouts.Payout(timestamp=now, txid=txid, requests=reqs)
+        session.add(payout)
+        session.commit()
+        for r in reqs:
+            session.refresh(r)
+
+def legacy_bad(engine, reqs):
+    with Session(engine) as session:
+        for r in reqs:
+            session.add(r)
+        session.commit()
+        for r in reqs:
+            session.refresh(r)
+
+def run(name, paid, bad, batches):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    start = time.perf_counter()
+    for b in range(batches):
+        if b % 2 == 0:
+            paid(now, "%064x" % (b,), make_reqs(b))
+        else:
+            bad(make_reqs(b))
+    elapsed = time.perf_counter() - start
+    return dict(bench="inserts", variant=name, batches=batches, rows=batches * BATCH, seconds=round(elapsed, 4), rows_per_sec=round(batches * BATCH / elapsed))
+
+def main():
+    batches = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    with tempfile.TemporaryDirectory() as d:
+        os.chdir(d)
+        os.mkdir("payouts")
+
+        engine = create_engine("sqlite:///./payouts/legacy.sqlite")
+        SQLModel.metadata.create_all(engine)
+        print(json.dumps(run("orm-refresh", lambda now, txid, reqs: legacy_paid(engine, now, txid, reqs), lambda reqs: legacy_bad(engine, reqs), batches)))
+        engine.dispose()
+
+        db = faucetpayouts.PayoutDB()
+        print(json.dumps(run("core-executemany", db.add_paid_reqs, db.add_bad_reqs, batches)))
+        db.engine.dispose()
+
+if __name__ == "__main__":
+    main()
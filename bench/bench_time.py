@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Parsing request timestamps with timestuff.totime against strptime, and
+# storing them as sqlalchemytime.TimeStamp text against IntTimeStamp
+# integers: db size, and a range scan over idx_userid_time.
+#
+#   python bench/bench_time.py [rows]
+
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sqlalchemy as sa
+
+import sqlalchemytime
+import timestuff
+
+PARSES = 100000
+USERS = 1000
+
+def bench_parse() -> dict:
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    strs = [timestuff.fromtime(start + datetime.timedelta(microseconds=random.randrange(10**14))) for _ in range(PARSES)]
+    result = dict(bench="time_parse", parses=PARSES)
+    for name, fn in [("strptime", timestuff.strptime), ("totime", timestuff.totime)]:
+        seconds = min(timeit.repeat(lambda: [fn(s) for s in strs], number=1, repeat=3))
+        result[name + "_us"] = round(seconds / PARSES * 1e6, 3)
+    result["speedup"] = round(result["strptime_us"] / result["totime_us"], 1)
+    return result
+
+def bench_storage(name : str, coltype, rows : int, path : str) -> dict:
+    engine = sa.create_engine(f"sqlite:///{path}")
+    md = sa.MetaData()
+    t = sa.Table("request", md,
+                 sa.Column("id", sa.Integer, primary_key=True),
+                 sa.Column("userid", sa.Integer),
+                 sa.Column("timestamp", coltype, index=True),
+                 sa.Index("idx_userid_time", "userid", "timestamp"))
+    md.create_all(engine)
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    data = [dict(userid=i % USERS, timestamp=start + datetime.timedelta(seconds=i * 7, microseconds=i)) for i in range(rows)]
+    before = time.perf_counter()
+    with engine.begin() as conn:
+        conn.execute(sa.insert(t), data)
+    insert_seconds = time.perf_counter() - before
+
+    # the worker's rate limit lookup: each user's latest request since a time
+    since = start + datetime.timedelta(seconds=rows * 7 // 2)
+    q = sa.select(t.c.userid, sa.func.max(t.c.timestamp)).where(t.c.userid.in_(range(USERS))).where(t.c.timestamp >= since).group_by(t.c.userid)
+    with engine.connect() as conn:
+        scan_seconds = min(timeit.repeat(lambda: conn.execute(q).all(), number=1, repeat=5))
+    engine.dispose()
+    return dict(bench="time_storage", type=name, rows=rows, db_bytes=os.path.getsize(path),
+                insert_seconds=round(insert_seconds, 4), range_scan_seconds=round(scan_seconds, 4))
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    random.seed(1)
+    print(json.dumps(bench_parse()))
+    with tempfile.TemporaryDirectory() as d:
+        for name, coltype in [("TimeStamp", sqlalchemytime.TimeStamp()), ("IntTimeStamp", sqlalchemytime.IntTimeStamp())]:
+            print(json.dumps(bench_storage(name, coltype, rows, os.path.join(d, name + ".sqlite"))))
+
+if __name__ == "__main__":
+    main()
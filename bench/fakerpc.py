@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# A stand-in for bitcoind's wallet JSON-RPC interface, good enough to
+# drive payout.Worker: transactions are just hex-encoded JSON, and txids
+# are the double-SHA256 of that.
+#
+#   python bench/fakerpc.py [--port P] [--latency SECONDS] [--cookie FILE]
+
+from typing import Any
+
+import argparse
+import decimal
+import hashlib
+import http.server
+import json
+import threading
+import time
+
+class FakeBitcoind:
+    def __init__(self, latency : float = 0.0, balance : str = "100.0"):
+        self.latency = latency
+        self.balance = balance
+        # a hundred confirmed coins adding up to the balance
+        self.unspent = [dict(txid="%064x" % (i + 1,), vout=0, amount=float(decimal.Decimal(balance) / 100), confirmations=6, spendable=True, safe=True) for i in range(100)]
+        self.addresses = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _enc(d : Any) -> str:
+        return json.dumps(d).encode('utf8').hex()
+
+    @staticmethod
+    def _dec(h : str) -> Any:
+        return json.loads(bytes.fromhex(h))
+
+    @staticmethod
+    def _txid(h : str) -> str:
+        return hashlib.sha256(hashlib.sha256(bytes.fromhex(h)).digest()).digest()[::-1].hex()
+
+    def getbalance(self):
+        return self.balance
+
+    def listunspent(self, minconf=1):
+        return [u for u in self.unspent if u["confirmations"] >= minconf]
+
+    def getnewaddress(self, label="", address_type=None):
+        with self._lock:
+            self.addresses += 1
+            n = self.addresses
+        return "tb1qfake%032x" % (n,)
+
+    def createrawtransaction(self, inputs, outputs):
+        return self._enc(dict(vin=inputs, vout=outputs))
+
+    def fundrawtransaction(self, h, options=None):
+        tx = self._dec(h)
+        with self._lock:
+            n = self.calls
+        if (options or {}).get("add_inputs", True):
+            tx["vin"] = tx["vin"] + [dict(txid="%064x" % (n,), vout=0)]
+        return dict(hex=self._enc(tx), fee="0.0001", changepos=-1)
+
+    def signrawtransactionwithwallet(self, h):
+        return dict(hex=h, complete=True)
+
+    def testmempoolaccept(self, hexes):
+        return [dict(txid=self._txid(h), allowed=True) for h in hexes]
+
+    def sendrawtransaction(self, h):
+        return self._txid(h)
+
+    def decoderawtransaction(self, h):
+        tx = self._dec(h)
+        return dict(txid=self._txid(h), vin=tx["vin"], vout=tx["vout"])
+
+    def lockunspent(self, unlock, outputs=None):
+        return True
+
+    def handle(self, req : dict) -> dict:
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        fn = getattr(self, req.get("method", "_"), None)
+        if fn is None or req["method"].startswith("_") or req["method"] == "handle":
+            return dict(result=None, error=dict(code=-32601, message="Method not found"), id=req.get("id"))
+        try:
+            return dict(result=fn(*req.get("params", [])), error=None, id=req.get("id"))
+        except Exception as e:
+            return dict(result=None, error=dict(code=-1, message=str(e)), id=req.get("id"))
+
+def serve(fake : FakeBitcoind, port : int = 0) -> http.server.ThreadingHTTPServer:
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if isinstance(body, list):
+                resp, status = [fake.handle(r) for r in body], 200
+            else:
+                resp = fake.handle(body)
+                status = 200 if resp["error"] is None else 500
+            data = json.dumps(resp).encode('utf8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=38332)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--cookie", default=None, help="write a matching cookie file here")
+    args = parser.parse_args()
+    if args.cookie:
+        with open(args.cookie, "w") as f:
+            f.write("__cookie__:fake\n")
+    server = serve(FakeBitcoind(latency=args.latency), args.port)
+    print(f"listening on 127.0.0.1:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
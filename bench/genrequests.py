@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Writes synthetic request files into requests/current, named and hashed
+# the way faucetrequests.Requests.create does.
+#
+#   python bench/genrequests.py N [--users U] [--repeat-addresses F] [--invalid F]
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bitcoinaddr
+import faucetrequests
+
+from timestuff import fromtime, utcnow
+
+def encode_segwit(witver : int, prog : bytes) -> str:
+    data = [witver] + bitcoinaddr._convertbits(list(prog), 8, 5, pad=True)
+    hrp = bitcoinaddr.HRP
+    const = bitcoinaddr.BECH32_CONST if witver == 0 else bitcoinaddr.BECH32M_CONST
+    values = [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp] + data
+    polymod = bitcoinaddr._bech32_polymod(values + [0] * 6) ^ const
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + "1" + "".join(bitcoinaddr.BECH32_CHARSET[d] for d in data + checksum)
+
+def make_address(rng : random.Random) -> str:
+    # mostly p2wpkh, with some p2tr and p2wsh
+    k = rng.random()
+    if k < 0.7:
+        return encode_segwit(0, rng.randbytes(20))
+    elif k < 0.9:
+        return encode_segwit(1, rng.randbytes(32))
+    else:
+        return encode_segwit(0, rng.randbytes(32))
+
+def generate(n : int, users : int = 0, repeat_addresses : float = 0.0, invalid : float = 0.0, path : str = faucetrequests.CURRENT, seed : int = 0) -> int:
+    # users=0 means every request comes from a different user
+    rng = random.Random(seed)
+    current = pathlib.Path(path)
+    current.mkdir(parents=True, exist_ok=True)
+    start = utcnow() - datetime.timedelta(seconds=n)
+    addresses = []
+    for i in range(n):
+        user_id = 10**17 + (rng.randrange(users) if users else i)
+        if addresses and rng.random() < repeat_addresses:
+            address = rng.choice(addresses)
+        elif rng.random() < invalid:
+            address = "tb1q" + "".join(rng.choice("0123456789") for _ in range(38))
+        else:
+            address = make_address(rng)
+            addresses.append(address)
+        t = fromtime(start + datetime.timedelta(seconds=i, microseconds=rng.randrange(10**6)))
+        d = dict(timestamp=t,
+                 interaction_id=2 * 10**17 + i,
+                 guild_id=3 * 10**17,
+                 user_id=user_id,
+                 user_name=f"user{user_id % 10**6}",
+                 user_created=fromtime(start - datetime.timedelta(days=365)),
+                 address=address)
+        j = json.dumps(d).encode('utf8')
+        h = hashlib.sha256(j).hexdigest()
+        with (current / (t + "-" + h + ".json")).open("xb") as f:
+            f.write(j)
+    return n
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("n", type=int)
+    parser.add_argument("--users", type=int, default=0, help="number of distinct users (default: one per request)")
+    parser.add_argument("--repeat-addresses", type=float, default=0.0, help="fraction of requests reusing an earlier address")
+    parser.add_argument("--invalid", type=float, default=0.0, help="fraction of requests with an invalid address")
+    parser.add_argument("--path", default=faucetrequests.CURRENT)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate(args.n, args.users, args.repeat_addresses, args.invalid, args.path, args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Checks that an address is valid for signet (which uses testnet's
+# address formats), and returns the scriptPubKey it pays to. bech32 and
+# bech32m decoding follows the reference code in BIP 173 and BIP 350.
+
+from typing import List, Optional, Tuple
+
+import hashlib
+
+HRP = "tb"
+P2PKH_VERSION = 0x6f
+P2SH_VERSION = 0xc4
+
+BECH32_CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+BECH32_CONST = 1
+BECH32M_CONST = 0x2bc830a3
+
+BASE58_CHARSET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+def _bech32_polymod(values : List[int]) -> int:
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    chk = 1
+    for value in values:
+        top = chk >> 25
+        chk = (chk & 0x1ffffff) << 5 ^ value
+        for i in range(5):
+            chk ^= generator[i] if ((top >> i) & 1) else 0
+    return chk
+
+def _bech32_decode(bech : str) -> Optional[Tuple[str, List[int], int]]:
+    if any(ord(x) < 33 or ord(x) > 126 for x in bech):
+        return None
+    if bech.lower() != bech and bech.upper() != bech:
+        return None
+    bech = bech.lower()
+    pos = bech.rfind('1')
+    if pos < 1 or pos + 7 > len(bech) or len(bech) > 90:
+        return None
+    if not all(x in BECH32_CHARSET for x in bech[pos+1:]):
+        return None
+    hrp = bech[:pos]
+    data = [BECH32_CHARSET.find(x) for x in bech[pos+1:]]
+    const = _bech32_polymod([ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp] + data)
+    if const not in (BECH32_CONST, BECH32M_CONST):
+        return None
+    return hrp, data[:-6], const
+
+def _convertbits(data : List[int], frombits : int, tobits : int, pad : bool = False) -> Optional[List[int]]:
+    acc = 0
+    bits = 0
+    ret = []
+    maxv = (1 << tobits) - 1
+    for value in data:
+        if value < 0 or (value >> frombits):
+            return None
+        acc = (acc << frombits) | value
+        bits += frombits
+        while bits >= tobits:
+            bits -= tobits
+            ret.append((acc >> bits) & maxv)
+    if pad:
+        if bits:
+            ret.append((acc << (tobits - bits)) & maxv)
+    elif bits >= frombits or ((acc << (tobits - bits)) & maxv):
+        return None
+    return ret
+
+def _segwit_script(address : str) -> Optional[bytes]:
+    dec = _bech32_decode(address)
+    if dec is None:
+        return None
+    hrp, data, const = dec
+    if hrp != HRP or not data:
+        return None
+    witver = data[0]
+    prog = _convertbits(data[1:], 5, 8)
+    if witver > 16 or prog is None or not 2 <= len(prog) <= 40:
+        return None
+    if witver == 0 and len(prog) not in (20, 32):
+        return None
+    if (witver == 0) != (const == BECH32_CONST):
+        return None
+    return bytes([witver + 0x50 if witver else 0, len(prog)] + prog)
+
+def _base58_script(address : str) -> Optional[bytes]:
+    n = 0
+    for c in address:
+        i = BASE58_CHARSET.find(c)
+        if i < 0:
+            return None
+        n = n * 58 + i
+    pad = len(address) - len(address.lstrip('1'))
+    raw = b"\0" * pad + (n.to_bytes((n.bit_length() + 7) // 8, 'big') if n else b"")
+    if len(raw) != 25:
+        return None
+    payload, checksum = raw[:-4], raw[-4:]
+    if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum:
+        return None
+    if payload[0] == P2PKH_VERSION:
+        return b"\x76\xa9\x14" + payload[1:] + b"\x88\xac"
+    if payload[0] == P2SH_VERSION:
+        return b"\xa9\x14" + payload[1:] + b"\x87"
+    return None
+
+def script_pubkey(address : str) -> Optional[bytes]:
+    # None unless address is a valid signet address
+    if not 0 < len(address) <= 90:
+        return None
+    if address[:len(HRP)+1].lower() == HRP + "1":
+        return _segwit_script(address)
+    return _base58_script(address)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+from typing import Any, List, Optional, Sequence, Union
+
+import base64
+import decimal
+import http.client
+import json
+import pathlib
+
+import metrics
+
+RPC_HOST = "127.0.0.1"
+RPC_PORT = 38332
+COOKIE = "~/.bitcoin/signet/.cookie"
+
+RPC_SECONDS = metrics.Histogram("faucet_rpc_seconds", "Latency of bitcoind RPC calls", ["method"])
+RPC_ERRORS = metrics.Counter("faucet_rpc_errors_total", "bitcoind RPC calls that failed", ["method"])
+
+class RPCError(Exception):
+    # code is bitcoind's RPC error code, or None if the request never got
+    # a JSON-RPC response (connection refused, bad auth, garbled reply...)
+    def __init__(self, code : Optional[int], message : str, method : Optional[str] = None):
+        super().__init__(f"{method}: {message} ({code})" if method else f"{message} ({code})")
+        self.code = code
+        self.message = message
+        self.method = method
+
+def _json_default(o):
+    if isinstance(o, decimal.Decimal):
+        return str(o)
+    raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
+
+class RPC:
+    def __init__(self, host : str = RPC_HOST, port : int = RPC_PORT, cookie : str = COOKIE, wallet : Optional[str] = "", timeout : float = 120):
+        self._host = host
+        self._port = port
+        self._cookie = pathlib.Path(cookie).expanduser()
+        self._timeout = timeout
+        self._path = "/" if wallet is None else "/wallet/" + wallet
+        self._conn : Optional[http.client.HTTPConnection] = None
+        self._auth : Optional[str] = None
+        self._id = 0
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self._conn is None:
+            # bitcoind writes a new cookie every time it starts, so pick it
+            # up again whenever we reconnect
+            self._auth = "Basic " + base64.b64encode(self._cookie.read_bytes().strip()).decode('ascii')
+            self._conn = http.client.HTTPConnection(self._host, self._port, timeout=self._timeout)
+        return self._conn
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _post(self, payload : Any) -> Any:
+        body = json.dumps(payload, default=_json_default).encode('utf8')
+        for attempt in (0, 1):
+            reused = self._conn is not None
+            try:
+                conn = self._connect()
+                conn.request("POST", self._path, body, {"Authorization": self._auth, "Content-Type": "application/json"})
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.HTTPException, OSError) as e:
+                self.close()
+                # a keep-alive connection may have been dropped by bitcoind
+                # while idle; retry once on a fresh one
+                if reused and attempt == 0:
+                    continue
+                raise RPCError(None, f"connection failed: {e}")
+            if resp.status == 401:
+                self.close()
+                if attempt == 0:
+                    continue
+                raise RPCError(None, "authorization failed")
+            try:
+                return json.loads(data, parse_float=decimal.Decimal)
+            except ValueError:
+                self.close()
+                raise RPCError(None, f"bad response: HTTP {resp.status}")
+
+    def _request(self, method : str, params : Sequence) -> dict:
+        self._id += 1
+        return {"jsonrpc": "1.0", "id": self._id, "method": method, "params": list(params)}
+
+    @staticmethod
+    def _result(method : str, r : dict) -> Any:
+        err = r.get("error")
+        if err is not None:
+            return RPCError(err.get("code"), err.get("message", ""), method)
+        return r.get("result")
+
+    def call(self, method : str, *params) -> Any:
+        try:
+            with RPC_SECONDS.time(method=method):
+                r = self._result(method, self._post(self._request(method, params)))
+        except RPCError:
+            RPC_ERRORS.inc(method=method)
+            raise
+        if isinstance(r, RPCError):
+            RPC_ERRORS.inc(method=method)
+            raise r
+        return r
+
+    def batch(self, calls : Sequence[Sequence]) -> List[Union[Any, RPCError]]:
+        # each call is (method, *params); results come back in the same
+        # order, with an RPCError in place of any call that failed
+        if not calls:
+            return []
+        reqs = [self._request(c[0], c[1:]) for c in calls]
+        with RPC_SECONDS.time(method="batch"):
+            resp = self._post(reqs)
+        if not isinstance(resp, list):
+            raise RPCError(None, "bad response to batch request")
+        byid = {r.get("id"): r for r in resp}
+        result : List[Union[Any, RPCError]] = []
+        for c, req in zip(calls, reqs):
+            r = byid.get(req["id"])
+            result.append(RPCError(None, "missing from batch response", c[0]) if r is None else self._result(c[0], r))
+        return result
+
+    def __getattr__(self, method : str):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return lambda *params: self.call(method, *params)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+from typing import Optional
+
+import os
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+POLL_INTERVAL = 1.0
+
+class DirWatcher:
+    # Wakes up when files are written into or renamed into a directory.
+    # Uses inotify if inotify_simple is available, otherwise falls back to
+    # polling the directory's mtime.
+    def __init__(self, path : str, poll_interval : float = POLL_INTERVAL):
+        self._path = path
+        self._poll_interval = poll_interval
+        self._inotify = None
+        if inotify_simple is not None:
+            try:
+                self._inotify = inotify_simple.INotify()
+                self._inotify.add_watch(path, inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO)
+            except OSError:
+                self._inotify = None
+        self._mtime = self._stat()
+
+    def _stat(self) -> Optional[int]:
+        try:
+            return os.stat(self._path).st_mtime_ns
+        except OSError:
+            return None
+
+    def clear(self) -> None:
+        # forget about any changes seen so far
+        if self._inotify is not None:
+            self._inotify.read(timeout=0)
+        else:
+            self._mtime = self._stat()
+
+    def wait(self, timeout : float) -> bool:
+        # True if the directory changed, False if the timeout expired first
+        if self._inotify is not None:
+            return len(self._inotify.read(timeout=int(timeout * 1000))) > 0
+        deadline = time.monotonic() + timeout
+        while True:
+            m = self._stat()
+            if m != self._mtime:
+                self._mtime = m
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self._poll_interval, remaining))
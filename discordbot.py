@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 
+import asyncio
 import datetime
 import json
 import logging
+import os
+import sys
+import time
+import weakref
 
 from hashlib import sha256
 
@@ -12,9 +17,13 @@ import discord
 import discord.ext.tasks
 from discord import app_commands
 
+import bitcoinaddr
+import dirwatch
 import faucetrecent
 import faucetrequests
 import faucetstatus
+import metrics
+import tokenbucket
 
 from timestuff import timedeltahuman, totime, utcnow
 
@@ -22,12 +31,60 @@ TOKEN = open("DISCORD-TOKEN").read().strip()
 PATH = './requests'
 TXURL = "https://mempool.space/signet/tx/%s"
 
+# Several instances can share the load by each running some of the
+# shards (and so some of the guilds), eg "discordbot.py 0,1 4" and
+# "discordbot.py 2,3 4". With no arguments one instance runs them all.
+SHARD_IDS : Optional[List[int]] = None
+SHARD_COUNT : Optional[int] = None
+if len(sys.argv) == 3:
+    SHARD_IDS = [int(i) for i in sys.argv[1].split(",")]
+    SHARD_COUNT = int(sys.argv[2])
+SHARD_TAG = "" if SHARD_IDS is None else "-" + "_".join(map(str, SHARD_IDS))
+# the instance running shard 0 does the jobs that only need doing once
+PRIMARY = SHARD_IDS is None or 0 in SHARD_IDS
+
+EVENTS_CURSOR = f'./requests/events{SHARD_TAG}.cursor'
+# hash of the command tree as last synced with discord
+COMMANDS_HASH = './requests/commands.sha256'
+METRICS_FILE = f'./requests/metrics{SHARD_TAG}.prom'
+
+# Admission control, so the queue stays short enough for the worker to
+# drain promptly: new requests per second (and burst) for this instance,
+# and the most requests left pending across all instances.
+ADMIT_RATE = 2.0
+ADMIT_BURST = 100
+MAX_PENDING = 5000
+
+COMMAND_SECONDS = metrics.Histogram("faucet_bot_command_seconds", "Time the bot spent handling each command, by result", ["command", "result"])
+INTERACTIONS = metrics.Gauge("faucet_bot_interactions", "Interactions waiting for their request to complete")
+COMPLETED = metrics.Counter("faucet_bot_completed_total", "Requests completed by the bot, by outcome", ["outcome"])
+ADMISSION = metrics.Counter("faucet_bot_requests_total", "Requests made with /request, by outcome", ["outcome"])
+PENDING = metrics.Gauge("faucet_bot_pending", "Requests not yet completed, as last counted")
+
 def txurl(txid : str) -> str:
     return TXURL % (txid,)
 
-class MyClient(discord.Client):
-    def __init__(self, *, intents: discord.Intents):
-        super().__init__(intents=intents)
+def observe_command(interaction : discord.Interaction, result : str) -> None:
+    started = interaction.extras.get("started")
+    if started is None: return
+    name = interaction.command.name if interaction.command is not None else "unknown"
+    COMMAND_SECONDS.observe(time.monotonic() - started, command=name, result=result)
+
+class FaucetTree(app_commands.CommandTree):
+    # times each command from when the bot starts handling it, so commands
+    # that raise are counted too; completions are timed by
+    # on_app_command_completion
+    async def interaction_check(self, interaction: discord.Interaction, /) -> bool:
+        interaction.extras["started"] = time.monotonic()
+        return True
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError, /) -> None:
+        observe_command(interaction, "error")
+        await super().on_error(interaction, error)
+
+class MyClient(discord.AutoShardedClient):
+    def __init__(self, *, intents: discord.Intents, shard_ids: Optional[List[int]] = None, shard_count: Optional[int] = None):
+        super().__init__(intents=intents, shard_ids=shard_ids, shard_count=shard_count)
         # A CommandTree is a special type that holds all the application command
         # state required to make it work. This is a separate class because it
         # allows all the extra state to be opt-in.
@@ -35,9 +92,19 @@ class MyClient(discord.Client):
         # to store and work with them.
         # Note: When using commands.Bot instead of discord.Client, the bot will
         # maintain its own tree instead.
-        self.tree = app_commands.CommandTree(self)
-        self.recent = faucetrecent.RecentDB()
+        self.tree = FaucetTree(self)
+        self.recent = faucetrecent.AsyncRecentDB()
         self.interactions : Dict[str, discord.Interaction] = {}
+        # held from the requests_since check until the new request is
+        # recorded, now that the db calls yield to the event loop
+        self.user_locks : weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+        self.admission = tokenbucket.TokenBucket(ADMIT_RATE, ADMIT_BURST)
+
+    def user_lock(self, user_id : int) -> asyncio.Lock:
+        lock = self.user_locks.get(user_id)
+        if lock is None:
+            lock = self.user_locks[user_id] = asyncio.Lock()
+        return lock
 
     # In this basic example, we just synchronize the app commands to one guild.
     # Instead of specifying a guild to every command, we copy over our global commands instead.
@@ -45,12 +112,30 @@ class MyClient(discord.Client):
     async def setup_hook(self):
         # This copies the global commands over to your guild.
         #self.tree.copy_global_to(guild=MY_GUILD)
+        if not PRIMARY: return
+        # syncing is a rate limited round trip, so skip it if the commands
+        # haven't changed since last time
+        tree = [c.to_dict(self.tree) for c in self.tree.get_commands()]
+        h = sha256(json.dumps([self.application_id, tree], sort_keys=True).encode('utf8')).hexdigest()
+        try:
+            with open(COMMANDS_HASH) as f:
+                if f.read().strip() == h:
+                    logging.info("Command tree unchanged, not syncing")
+                    return
+        except FileNotFoundError:
+            pass
         r = await self.tree.sync()
         print(f"sync result: {[sr.name for sr in r]}")
+        with open(COMMANDS_HASH + ".tmp", "w") as f:
+            f.write(h + "\n")
+        os.rename(COMMANDS_HASH + ".tmp", COMMANDS_HASH)
 
 intents = discord.Intents.default()
-client = MyClient(intents=intents)
-requests = faucetrequests.Requests()
+client = MyClient(intents=intents, shard_ids=SHARD_IDS, shard_count=SHARD_COUNT)
+requests = faucetrequests.open_requests()
+statusfile = faucetstatus.StatusReader()
+events = faucetstatus.EventReader(EVENTS_CURSOR)
+payouts_watch = dirwatch.DirWatcher(os.path.dirname(faucetstatus.FILE_STATUS))
 
 async def edit_orig_resp(req : str, **kwargs) -> None:
     if req not in client.interactions: return
@@ -62,31 +147,90 @@ async def cleanup():
     for s in list(client.interactions):
         if client.interactions[s].is_expired():
             del client.interactions[s]
+    INTERACTIONS.set(len(client.interactions))
+    PENDING.set(await client.recent.recount_pending())
+    metrics.write(METRICS_FILE)
 
-    s = faucetstatus.Status.read()
-    if s is None: return
+@discord.ext.tasks.loop(seconds=0)
+async def follow_events():
+    # an exception would stop the loop for good; anything missed here is
+    # journaled again by the worker (see payout.REJOURNAL_AFTER)
+    try:
+        new = await asyncio.to_thread(events.read)
+        outcomes : Dict[str, Optional[str]] = {}
+        for e in new:
+            for req in e.filenames:
+                outcomes[req] = e.txid
+        if outcomes:
+            await complete_outcomes(outcomes)
+            await asyncio.to_thread(events.commit)
+    except Exception:
+        logging.exception("could not complete requests from the event log")
+    # the worker rewrites status.json after appending to the event log
+    await asyncio.to_thread(payouts_watch.wait, 5)
+
+async def complete_outcomes(outcomes : Dict[str, Optional[str]]) -> None:
+    # every instance follows the event log; whichever moves a request to
+    # complete/ records it, but the instance that took the request may be
+    # another one, and it still needs to update its response
+    done = await asyncio.to_thread(requests.complete_many, list(outcomes))
     recent_cleanup = []
-    for txid in s.current_payouts:
-        for req in s.current_payouts[txid]:
-            if requests.complete(req):
+    edited = []
+    edits = []
+    for req, txid in outcomes.items():
+        if done.get(req):
+            COMPLETED.inc(outcome="failed" if txid is None else "paid")
+            if txid is not None:
                 logging.info(f"Successful payout of {req} via {txid}")
-                await edit_orig_resp(req, content=None, embed=discord.Embed(description=f"Request [successful]({txurl(txid)})."))
-                recent_cleanup.append((req, txid))
-                del client.interactions[req]
-    for req in s.current_rejects:
-        if requests.complete(req):
-            logging.info(f"Failed payout of {req}")
-            if req in client.interactions:
-                edit_orig_resp(req, content="Request for funds failed")
-            recent_cleanup.append((req, None))
-            del client.interactions[req]
-    client.recent.complete_requests(recent_cleanup)
+            else:
+                logging.info(f"Failed payout of {req}")
+            recent_cleanup.append((req, txid))
+        if req not in client.interactions: continue
+        if txid is not None:
+            edits.append(edit_orig_resp(req, content=None, embed=discord.Embed(description=f"Request [successful]({txurl(txid)}).")))
+        else:
+            edits.append(edit_orig_resp(req, content="Request for funds failed"))
+        edited.append(req)
+
+    if recent_cleanup:
+        await client.recent.complete_requests(recent_cleanup)
+    for req, r in zip(edited, await asyncio.gather(*edits, return_exceptions=True)):
+        if isinstance(r, Exception):
+            logging.debug(f"Could not update response for {req}: {r}")
+        client.interactions.pop(req, None)
+
+@discord.ext.tasks.loop(hours=1)
+async def prune_recent():
+    n = await client.recent.prune(utcnow() - faucetrecent.RETENTION)
+    if n > 0:
+        logging.info(f"Pruned {n} old requests from recent db")
+        await client.recent.vacuum()
+
+@discord.ext.tasks.loop(hours=1)
+async def compact_requests():
+    # the queue only exports completed requests to requests/complete here
+    try:
+        n = await asyncio.to_thread(requests.compact)
+    except Exception:
+        logging.exception("could not compact completed requests")
+        return
+    if n > 0:
+        logging.info(f"Packed {n} completed requests into segments")
 
 @client.event
 async def on_ready():
     logging.info(f'Logged in as {client.user} (ID: {client.user.id})')
     logging.info('------')
     cleanup.start()
+    follow_events.start()
+    if PRIMARY:
+        prune_recent.start()
+        if faucetrequests.BACKEND == "queue":
+            compact_requests.start()
+
+@client.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    observe_command(interaction, "ok")
 
 @client.tree.command()
 @app_commands.describe(
@@ -96,38 +240,62 @@ async def request(interaction: discord.Interaction, address: str):
     """Requests funds from the faucet"""
     assert isinstance(interaction.client, MyClient)
     logging.info(f"Request for {interaction.user.name} to {address}")
-    s = faucetstatus.Status.read()
-    prevreqs = interaction.client.recent.requests_since(interaction.user.id, utcnow() - s.request_frequency)
-    if not prevreqs and (reqd := requests.create(interaction, address)):
-        req = faucetrecent.RecentReq(
-            filename=reqd["filename"],
-            timestamp=totime(reqd["timestamp"]),
-            user_name=reqd["user_name"],
-            user_id=reqd["user_id"],
-            address=reqd["address"],
-        )
-        interaction.client.recent.add_request(req)
+    if bitcoinaddr.script_pubkey(address) is None:
+        await interaction.response.send_message(f"Request for funds ignored, {address} is not a valid signet address.", ephemeral=True)
+        return
+    s = statusfile.read()
+    refusal = None
+    async with interaction.client.user_lock(interaction.user.id):
+        prevreqs = await interaction.client.recent.requests_since(interaction.user.id, utcnow() - s.request_frequency)
+        req = None
+        if prevreqs:
+            ADMISSION.inc(outcome="too_soon")
+        elif (refusal := await admit(s)) is None and (reqd := await asyncio.to_thread(requests.create, interaction, address)):
+            req = faucetrecent.RecentReq(
+                filename=reqd["filename"],
+                timestamp=totime(reqd["timestamp"]),
+                user_name=reqd["user_name"],
+                user_id=reqd["user_id"],
+                address=reqd["address"],
+            )
+            await interaction.client.recent.add_request(req)
+            ADMISSION.inc(outcome="accepted")
+    if req is not None:
         await interaction.response.send_message(f"Request for funds acknowledged", ephemeral=True)
         interaction.client.interactions[req.filename] = interaction
+    elif refusal is not None:
+        await interaction.response.send_message(f"Request for funds ignored, {refusal}", ephemeral=True)
     else:
         await interaction.response.send_message(f"Request for funds ignored, you need to wait at least {timedeltahuman(s.request_frequency)} between requests.", ephemeral=True)
 
+async def admit(s : faucetstatus.Status) -> Optional[str]:
+    # None if a new request can be queued, otherwise why not
+    pending = await client.recent.count_pending()
+    if pending >= MAX_PENDING:
+        ADMISSION.inc(outcome="queue_full")
+        return f"the faucet is busy with {pending} requests already; please try again in a few minutes."
+    if s.payout_cost(pending + 1) > s.faucet_balance:
+        ADMISSION.inc(outcome="low_funds")
+        return "the faucet doesn't have enough funds for the requests it already has; please try again later."
+    # checked last, so a refused request doesn't use up a token
+    if not client.admission.take():
+        ADMISSION.inc(outcome="rate_limited")
+        return "the faucet is getting too many requests right now; please try again in a minute."
+    return None
+
 @client.tree.command()
 async def status(interaction: discord.Interaction):
-    s = faucetstatus.Status.read()
+    s = statusfile.read()
     lc = timedeltahuman(utcnow() - s.last_check)
     msg = f'Last check for payment requests {lc} ago, faucet balance {s.faucet_balance}.'
-    pending = client.recent.count_pending()
+    pending = await client.recent.count_pending()
     if pending > 0:
         msg += f' {pending} requests currently pending.'
     await interaction.response.send_message(msg)
 
-@client.tree.command()
-async def history(interaction: discord.Interaction):
-    assert isinstance(interaction.client, MyClient)
-    h = interaction.client.recent.history(interaction.user.id)
+def history_embed(rows) -> discord.Embed:
     resp = []
-    for hi in h:
+    for hi in rows:
         if hi.completed is not None:
             state = f"[paid]({txurl(hi.txid)})" if hi.txid else "failed"
             t = hi.completed
@@ -135,13 +303,59 @@ async def history(interaction: discord.Interaction):
             state = "pending"
             t = hi.timestamp
         resp.append(f" * <t:{int(t.timestamp())}:R> funds to {hi.address} ({state})")
-    if resp:
-        e = discord.Embed(description=f"Your requests:\n\n{'\n'.join(resp)}\n")
-        await interaction.response.send_message(embed=e, ephemeral=True)
+    return discord.Embed(description=f"Your requests:\n\n{'\n'.join(resp)}\n")
+
+class HistoryView(discord.ui.View):
+    # newer/older buttons for paging through /history, keyed on the first
+    # and last rows shown
+    def __init__(self, user_id : int, rows, has_older : bool):
+        super().__init__(timeout=300)
+        self.user_id = user_id
+        self.show(rows, False, has_older)
+
+    def show(self, rows, has_newer : bool, has_older : bool) -> None:
+        self.first = faucetrecent.history_key(rows[0])
+        self.last = faucetrecent.history_key(rows[-1])
+        self.newer.disabled = not has_newer
+        self.older.disabled = not has_older
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return interaction.user.id == self.user_id
+
+    @discord.ui.button(label="Newer")
+    async def newer(self, interaction: discord.Interaction, button: discord.ui.Button):
+        rows, more = await client.recent.history_page(self.user_id, after=self.first)
+        await self.update(interaction, rows, more, True)
+
+    @discord.ui.button(label="Older")
+    async def older(self, interaction: discord.Interaction, button: discord.ui.Button):
+        rows, more = await client.recent.history_page(self.user_id, before=self.last)
+        await self.update(interaction, rows, True, more)
+
+    async def update(self, interaction: discord.Interaction, rows, has_newer : bool, has_older : bool) -> None:
+        if not rows:
+            # the rows either side were pruned; start again from the top
+            rows, has_older = await client.recent.history_page(self.user_id)
+            has_newer = False
+        if not rows:
+            await interaction.response.edit_message(content="You have not made any recent requests", embed=None, view=None)
+            return
+        self.show(rows, has_newer, has_older)
+        await interaction.response.edit_message(embed=history_embed(rows), view=self)
+
+@client.tree.command()
+async def history(interaction: discord.Interaction):
+    assert isinstance(interaction.client, MyClient)
+    rows, more = await interaction.client.recent.history_page(interaction.user.id)
+    if rows:
+        view = HistoryView(interaction.user.id, rows, more) if more else discord.utils.MISSING
+        await interaction.response.send_message(embed=history_embed(rows), view=view, ephemeral=True)
     else:
         await interaction.response.send_message(content="You have not made any recent requests", ephemeral=True)
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+if METRICS_FILE:
+    metrics.enable()
 
 client.run(TOKEN)
 
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+from typing import Callable, Iterable, Sequence
+
+import sqlalchemy as sa
+from sqlmodel import create_engine
+
+BUSY_TIMEOUT_MS = 5000
+POOL_SIZE = 5
+# stay well under SQLite's limit on bound parameters per statement
+IN_CHUNK = 500
+
+def chunked(items : Iterable, n : int = IN_CHUNK):
+    items = list(items)
+    for i in range(0, len(items), n):
+        yield items[i:i+n]
+
+def make_engine(url : str, echo=False) -> sa.engine.Engine:
+    # The bot and the payout worker both have the databases open at the
+    # same time, so use WAL (readers don't block the writer) and wait on a
+    # locked database rather than failing immediately.
+    engine = create_engine(url, echo=echo, pool_size=POOL_SIZE, max_overflow=POOL_SIZE)
+
+    @sa.event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_conn, conn_record):
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        cur.close()
+
+    return engine
+
+def migrate(engine : sa.engine.Engine, steps : Sequence[Callable[[sa.engine.Connection], None]]) -> int:
+    # Brings the schema up to date, steps[n] taking it from version n to
+    # n+1, with the version kept in PRAGMA user_version. Returns the version
+    # the db was at. Once up to date, this is a single pragma read.
+    with engine.connect() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        if version >= len(steps):
+            return version
+        # another process may be migrating too, so wait for the write
+        # lock and look again
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        for step in steps[version:]:
+            step(conn)
+        conn.exec_driver_sql(f"PRAGMA user_version={len(steps)}")
+        conn.commit()
+        return version
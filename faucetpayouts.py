@@ -1,20 +1,23 @@
 #!/usr/bin/env python3
 
-from typing import List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 import datetime
 import json
+import sys
 
 import sqlalchemy as sa
-from sqlmodel import Session, SQLModel, Field, Relationship, create_engine, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import Session, SQLModel, Field, Relationship, select
 
-from sqlalchemytime import TimeStamp
+from faucetdb import chunked, make_engine, migrate
+from sqlalchemytime import IntTimeStamp, to_epoch_us
 
 DB = "sqlite:///./payouts/audit.sqlite"
 
 class Payout(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    timestamp: datetime.datetime = Field(sa_column=sa.Column(TimeStamp(),
+    timestamp: datetime.datetime = Field(sa_column=sa.Column(IntTimeStamp(),
                                                              index=True,
                                                             ))
     txid: str = Field(index=True, unique=True)
@@ -28,7 +31,7 @@ class Request(SQLModel, table=True):
 
     id: int | None = Field(default=None, primary_key=True)
     filename: str = Field(index=True, unique=True)
-    timestamp: datetime.datetime = Field(sa_column=sa.Column(TimeStamp(),
+    timestamp: datetime.datetime = Field(sa_column=sa.Column(IntTimeStamp(),
                                                              index=True,
                                                             ))
     username: str = Field(index=True)
@@ -38,10 +41,117 @@ class Request(SQLModel, table=True):
 
     payout: Payout | None = Relationship(back_populates="requests")
 
+class Lease(SQLModel, table=True):
+    # a payout worker's claim on a user's requests; only the holder may
+    # pay or reject them until it releases the lease or it expires
+    userid: int = Field(primary_key=True)
+    worker: str
+    expires: datetime.datetime = Field(sa_column=sa.Column(IntTimeStamp(),
+                                                           index=True,
+                                                          ))
+
+# Rollups, kept up to date as requests are recorded, so stats don't need
+# to scan the request and payout tables. Requests are counted on the day
+# they were made, payouts on the day they were sent.
+class DailyStats(SQLModel, table=True):
+    day: str = Field(primary_key=True)   # YYYY-MM-DD, UTC
+    paid: int = 0
+    rejected: int = 0
+    payouts: int = 0
+
+class UserStats(SQLModel, table=True):
+    userid: int = Field(primary_key=True)
+    username: str
+    paid: int = Field(default=0, index=True)
+    rejected: int = 0
+    first_request: datetime.datetime = Field(sa_column=sa.Column(IntTimeStamp()))
+    last_request: datetime.datetime = Field(sa_column=sa.Column(IntTimeStamp()))
+    last_paid: Optional[datetime.datetime] = Field(sa_column=sa.Column(IntTimeStamp()))
+
+def day_of(t : datetime.datetime) -> str:
+    return t.astimezone(datetime.timezone.utc).strftime("%Y-%m-%d")
+
+def _later(a, b):
+    # max() of two nullable IntTimeStamp columns
+    return sa.case((a == None, b), (b == None, a), (a > b, a), else_=b)
+
+def _rollup(conn, reqs : List[Request], payout_day : Optional[str] = None):
+    days : Dict[str, dict] = {}
+    users : Dict[int, dict] = {}
+    for r in reqs:
+        paid = r.payout_id is not None
+        d = days.setdefault(day_of(r.timestamp), dict(paid=0, rejected=0, payouts=0))
+        d["paid" if paid else "rejected"] += 1
+        u = users.get(r.userid)
+        if u is None:
+            u = users[r.userid] = dict(userid=r.userid, username=r.username, paid=0, rejected=0, first_request=r.timestamp, last_request=r.timestamp, last_paid=None)
+        u["paid" if paid else "rejected"] += 1
+        u["first_request"] = min(u["first_request"], r.timestamp)
+        if r.timestamp >= u["last_request"]:
+            u["last_request"] = r.timestamp
+            u["username"] = r.username
+        if paid and (u["last_paid"] is None or r.timestamp > u["last_paid"]):
+            u["last_paid"] = r.timestamp
+    if payout_day is not None:
+        days.setdefault(payout_day, dict(paid=0, rejected=0, payouts=0))["payouts"] += 1
+
+    if not days:
+        return
+    dt = DailyStats.__table__
+    stmt = sqlite_insert(dt)
+    conn.execute(stmt.on_conflict_do_update(index_elements=[dt.c.day], set_=dict(
+        paid=dt.c.paid + stmt.excluded.paid,
+        rejected=dt.c.rejected + stmt.excluded.rejected,
+        payouts=dt.c.payouts + stmt.excluded.payouts,
+    )), [dict(day=k, **v) for k, v in days.items()])
+    if not users:
+        return
+    ut = UserStats.__table__
+    stmt = sqlite_insert(ut)
+    conn.execute(stmt.on_conflict_do_update(index_elements=[ut.c.userid], set_=dict(
+        username=sa.case((stmt.excluded.last_request >= ut.c.last_request, stmt.excluded.username), else_=ut.c.username),
+        paid=ut.c.paid + stmt.excluded.paid,
+        rejected=ut.c.rejected + stmt.excluded.rejected,
+        first_request=sa.case((stmt.excluded.first_request < ut.c.first_request, stmt.excluded.first_request), else_=ut.c.first_request),
+        last_request=_later(ut.c.last_request, stmt.excluded.last_request),
+        last_paid=_later(ut.c.last_paid, stmt.excluded.last_paid),
+    )), list(users.values()))
+
+def rebuild_stats(conn):
+    # recount the rollups from scratch
+    day = "strftime('%Y-%m-%d', {} / 1000000, 'unixepoch')"
+    conn.exec_driver_sql("DELETE FROM dailystats")
+    conn.exec_driver_sql("DELETE FROM userstats")
+    conn.exec_driver_sql(f"INSERT INTO dailystats (day, paid, rejected, payouts) SELECT {day.format('timestamp')} AS d, count(payout_id), count(*) - count(payout_id), 0 FROM request GROUP BY d")
+    conn.exec_driver_sql(f"INSERT INTO dailystats (day, paid, rejected, payouts) SELECT {day.format('timestamp')} AS d, 0, 0, count(*) FROM payout WHERE true GROUP BY d ON CONFLICT (day) DO UPDATE SET payouts = excluded.payouts")
+    conn.exec_driver_sql("INSERT INTO userstats (userid, username, paid, rejected, first_request, last_request, last_paid) "
+                         "SELECT userid, (SELECT username FROM request r2 WHERE r2.userid = r.userid ORDER BY timestamp DESC LIMIT 1), "
+                         "count(payout_id), count(*) - count(payout_id), min(timestamp), max(timestamp), max(CASE WHEN payout_id IS NOT NULL THEN timestamp END) "
+                         "FROM request r GROUP BY userid")
+
+def _schema_v1(conn):
+    # checkfirst, so this also adopts dbs made before there were versions
+    SQLModel.metadata.create_all(conn, tables=[Payout.__table__, Request.__table__, Lease.__table__])
+
+def _schema_v2(conn):
+    # text datetimes to IntTimeStamp
+    for table, column in [("payout", "timestamp"), ("request", "timestamp"), ("lease", "expires")]:
+        to_epoch_us(conn, table, column)
+
+def _schema_v3(conn):
+    SQLModel.metadata.create_all(conn, tables=[DailyStats.__table__, UserStats.__table__])
+    rebuild_stats(conn)
+
+# see faucetdb.migrate
+MIGRATIONS = [_schema_v1, _schema_v2, _schema_v3]
+
+def request_row(r : Request) -> dict:
+    return dict(filename=r.filename, timestamp=r.timestamp, username=r.username, userid=r.userid, address=r.address, payout_id=r.payout_id)
+
 class PayoutDB:
     def __init__(self, echo=False):
-        self.engine = create_engine(DB, echo=echo)
-        SQLModel.metadata.create_all(self.engine)
+        self.engine = make_engine(DB, echo=echo)
+        migrate(self.engine, MIGRATIONS)
 
     def last_payout(self, userid : int) -> Tuple[Optional[Request], Optional[Payout]]:
         with Session(self.engine) as session:
@@ -62,20 +172,111 @@ class PayoutDB:
             else:
                 return True, r.payout.txid
 
+    def seen_many(self, filenames : Iterable[str]) -> Dict[str, Optional[str]]:
+        # filename -> payout txid, or None if it was rejected
+        result : Dict[str, Optional[str]] = {}
+        with Session(self.engine) as session:
+            for chunk in chunked(set(filenames)):
+                results = session.exec(select(Request.filename, Payout.txid).join(Payout, isouter=True).where(Request.filename.in_(chunk)))
+                for filename, txid in results:
+                    result[filename] = txid
+        return result
+
+    def recent_payouts(self, since : datetime.datetime) -> Dict[int, datetime.datetime]:
+        # userid -> timestamp of their most recent paid request, for users
+        # with a paid request made since the given time
+        with Session(self.engine) as session:
+            results = session.exec(select(Request.userid, sa.func.max(Request.timestamp)).where(Request.timestamp >= since).where(Request.payout_id != None).group_by(Request.userid))
+            return {userid: timestamp for userid, timestamp in results}
+
+    def claim_users(self, worker : str, userids : Iterable[int], now : datetime.datetime, lease : datetime.timedelta) -> Tuple[Set[int], Dict[int, datetime.datetime]]:
+        # Lease as many of the given users as we can, dropping expired leases
+        # held by crashed workers. Returns the users claimed, along with the
+        # time each was last paid, read under the same write lock so that
+        # another worker can't pay them between the check and our payout.
+        claimed : Set[int] = set()
+        last_paid : Dict[int, datetime.datetime] = {}
+        userids = set(userids)
+        if not userids: return claimed, last_paid
+        lt = Lease.__table__
+        with self.engine.connect() as conn:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            conn.execute(sa.delete(lt).where(lt.c.expires < now))
+            for chunk in chunked(userids):
+                held = conn.execute(sa.select(lt.c.userid, lt.c.worker).where(lt.c.userid.in_(chunk)))
+                taken = {u for u, w in held if w != worker}
+                claimed.update(u for u in chunk if u not in taken)
+            expires = now + lease
+            for chunk in chunked(claimed):
+                conn.execute(sa.insert(lt).prefix_with("OR REPLACE"), [dict(userid=u, worker=worker, expires=expires) for u in chunk])
+                rt = Request.__table__
+                results = conn.execute(sa.select(rt.c.userid, sa.func.max(rt.c.timestamp)).where(rt.c.userid.in_(chunk)).where(rt.c.payout_id != None).group_by(rt.c.userid))
+                for userid, timestamp in results:
+                    last_paid[userid] = timestamp
+            conn.commit()
+        return claimed, last_paid
+
+    def release_users(self, worker : str, userids : Iterable[int]):
+        lt = Lease.__table__
+        with self.engine.connect() as conn:
+            for chunk in chunked(userids):
+                conn.execute(sa.delete(lt).where(lt.c.worker == worker).where(lt.c.userid.in_(chunk)))
+            conn.commit()
+
     def add_bad_reqs(self, reqs : List[Request]):
+        if not reqs: return
         with Session(self.engine) as session:
-            for r in reqs:
-                session.add(r)
+            session.execute(sa.insert(Request.__table__), [request_row(r) for r in reqs])
+            _rollup(session, reqs)
             session.commit()
-            for r in reqs:
-                session.refresh(r)
 
     def add_paid_reqs(self, now, txid : str, reqs : List[Request]):
         with Session(self.engine) as session:
-            payout = Payout(timestamp=now, txid=txid, requests=reqs)
-            session.add(payout)
-            session.commit()
+            result = session.execute(sa.insert(Payout.__table__).values(timestamp=now, txid=txid))
+            payout_id = result.inserted_primary_key[0]
             for r in reqs:
-                session.refresh(r)
+                r.payout_id = payout_id
+            if reqs:
+                session.execute(sa.insert(Request.__table__), [request_row(r) for r in reqs])
+            _rollup(session, reqs, day_of(now))
+            session.commit()
+
+    def daily_stats(self, days : int) -> List[DailyStats]:
+        # the last few days with any activity, most recent first
+        with Session(self.engine) as session:
+            return list(session.exec(select(DailyStats).order_by(DailyStats.day.desc()).limit(days)).all())
+
+    def top_users(self, n : int) -> List[UserStats]:
+        with Session(self.engine) as session:
+            return list(session.exec(select(UserStats).order_by(UserStats.paid.desc()).limit(n)).all())
+
+    def rebuild_stats(self):
+        with self.engine.connect() as conn:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            rebuild_stats(conn)
+            conn.commit()
 
+def print_stats(db : PayoutDB, days : int = 14, top : int = 10):
+    daily = db.daily_stats(days)
+    print(f"{'day':10} {'paid':>7} {'rejected':>8} {'reject%':>7} {'payouts':>7}")
+    for d in daily:
+        total = d.paid + d.rejected
+        rate = f"{100 * d.rejected / total:.1f}" if total else "-"
+        print(f"{d.day:10} {d.paid:7} {d.rejected:8} {rate:>7} {d.payouts:7}")
+    week = daily[:7]
+    paid, rejected = sum(d.paid for d in week), sum(d.rejected for d in week)
+    if paid + rejected:
+        print(f"last {len(week)} active days: {paid + rejected} requests, {100 * rejected / (paid + rejected):.1f}% rejected")
+    print()
+    print(f"{'userid':>20} {'username':20} {'paid':>6} {'rejected':>8} last paid")
+    for u in db.top_users(top):
+        print(f"{u.userid:20} {u.username[:20]:20} {u.paid:6} {u.rejected:8} {u.last_paid.strftime('%Y-%m-%d %H:%M') if u.last_paid else '-'}")
 
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["stats"]:
+        db = PayoutDB()
+        if "--rebuild" in sys.argv[2:]:
+            db.rebuild_stats()
+        print_stats(db)
+    else:
+        print("usage: faucetpayouts.py stats [--rebuild]")
@@ -1,17 +1,40 @@
 #!/usr/bin/env python3
 
-from typing import List, Optional, Sequence, Tuple
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
+import asyncio
+import collections
+import concurrent.futures
 import datetime
+import functools
+import gzip
 import json
+import pathlib
+import threading
+import time
 
 import sqlalchemy as sa
-from sqlmodel import Session, SQLModel, Field, Relationship, create_engine, select, update
+from sqlmodel import Session, SQLModel, Field, Relationship, select, update
 
-from sqlalchemytime import TimeStamp
-from timestuff import utcnow
+import metrics
+from faucetdb import make_engine, migrate
+from sqlalchemytime import IntTimeStamp, to_epoch_us
+from timestuff import fromtime, utcnow
 
 DB = "sqlite:///./requests/recent.sqlite"
+ARCHIVE = "./requests/archive"
+
+RETENTION = datetime.timedelta(days=30)
+PRUNE_BATCH = 500
+VACUUM_PAGES = 1000
+HISTORY_LIMIT = 25
+HISTORY_PAGE = 10
+HISTORY_CACHE_USERS = 1000
+# bot instances sharing the db don't see each other's invalidations, so
+# don't trust a cached page for long
+HISTORY_CACHE_TTL = 60
+
+QUERY_SECONDS = metrics.Histogram("faucet_recentdb_seconds", "Latency of recent.sqlite operations, including time queued", ["query"])
 
 class RecentReq(SQLModel, table=True):
     __table_args__ = (sa.Index("idx_userid_completed", "user_id", "timestamp"),
@@ -19,27 +42,104 @@ class RecentReq(SQLModel, table=True):
 
     id: int | None = Field(default=None, primary_key=True)
     filename: str = Field(index=True, unique=True)
-    timestamp: datetime.datetime = Field(sa_column=sa.Column(TimeStamp(),
+    timestamp: datetime.datetime = Field(sa_column=sa.Column(IntTimeStamp(),
                                                              index=True,
                                                             ))
     user_name: str
     user_id: int
     address: str
-    completed: Optional[datetime.datetime] = Field(sa_column=sa.Column(TimeStamp(),
+    completed: Optional[datetime.datetime] = Field(sa_column=sa.Column(IntTimeStamp(),
                                                                        index=True,
                                                                       ))
     txid: Optional[str]
 
+def _schema_v1(conn):
+    # checkfirst, so this also adopts dbs made before there were versions
+    SQLModel.metadata.create_all(conn, tables=[RecentReq.__table__])
+
+def _schema_v2(conn):
+    # text datetimes to IntTimeStamp
+    for table, column in [("recentreq", "timestamp"), ("recentreq", "completed")]:
+        to_epoch_us(conn, table, column)
+
+# see faucetdb.migrate
+MIGRATIONS = [_schema_v1, _schema_v2]
+
+# (timestamp, id) of a row, for paging through a user's history
+HistoryKey = Tuple[datetime.datetime, int]
+# a page of rows, newest first, and whether there are more beyond it
+HistoryPage = Tuple[List[RecentReq], bool]
+
+def history_key(r : RecentReq) -> HistoryKey:
+    return (r.timestamp, r.id)
+
 class RecentDB:
     def __init__(self, echo=False):
-        self.engine = create_engine(DB, echo=echo)
-        SQLModel.metadata.create_all(self.engine)
+        self.engine = make_engine(DB, echo=echo)
+        if migrate(self.engine, MIGRATIONS) < len(MIGRATIONS):
+            # auto_vacuum can only be changed by rebuilding the db, which
+            # can't happen inside the migration's transaction
+            with self.engine.connect() as conn:
+                if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+                    conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+                    conn.exec_driver_sql("VACUUM")
+        self.archive = pathlib.Path(ARCHIVE) if ARCHIVE else None
+        # user_id -> (before, after, limit) -> (expiry, page), least
+        # recently used user first
+        self._history_cache : collections.OrderedDict[int, Dict[tuple, Tuple[float, HistoryPage]]] = collections.OrderedDict()
+        self._history_lock = threading.Lock()
+        # bumped by every invalidation, so a page read while rows were
+        # changing isn't cached
+        self._history_gen = 0
+        # requests not yet completed, kept up to date by add_request and
+        # complete_requests; None until first counted
+        self.pending : Optional[int] = None
+
+    def _invalidate_history(self, user_ids : Optional[Iterable[int]] = None):
+        with self._history_lock:
+            self._history_gen += 1
+            if user_ids is None:
+                self._history_cache.clear()
+            else:
+                for u in user_ids:
+                    self._history_cache.pop(u, None)
 
-    def history(self, user_id: int) -> Sequence[RecentReq]:
+    def history(self, user_id: int, limit: int = HISTORY_LIMIT) -> Sequence[RecentReq]:
+        return self.history_page(user_id, limit=limit)[0]
+
+    def history_page(self, user_id: int, before: Optional[HistoryKey] = None, after: Optional[HistoryKey] = None, limit: int = HISTORY_PAGE) -> HistoryPage:
+        # Pass the key of the last row of a page as before to get the next
+        # (older) page, or of the first row as after to get the previous one.
+        k = (before, after, limit)
+        now = time.monotonic()
+        with self._history_lock:
+            pages = self._history_cache.get(user_id)
+            if pages is not None:
+                self._history_cache.move_to_end(user_id)
+                hit = pages.get(k)
+                if hit is not None and hit[0] > now:
+                    return hit[1]
+            gen = self._history_gen
+
+        q = select(RecentReq).where(RecentReq.user_id == user_id)
+        key = sa.tuple_(RecentReq.timestamp, RecentReq.id)
+        if after is not None:
+            q = q.where(key > after).order_by(RecentReq.timestamp, RecentReq.id)
+        else:
+            if before is not None:
+                q = q.where(key < before)
+            q = q.order_by(RecentReq.timestamp.desc(), RecentReq.id.desc())
         with Session(self.engine) as session:
-            results = session.exec(select(RecentReq).where(RecentReq.user_id == user_id).order_by(RecentReq.timestamp.desc()))
-            return results.all()
-        return []
+            rows = list(session.exec(q.limit(limit + 1)).all())
+        page = (rows[:limit] if after is None else rows[:limit][::-1], len(rows) > limit)
+
+        with self._history_lock:
+            if gen == self._history_gen:
+                self._history_cache.setdefault(user_id, {})[k] = (now + HISTORY_CACHE_TTL, page)
+                self._history_cache.move_to_end(user_id)
+                while len(self._history_cache) > HISTORY_CACHE_USERS:
+                    self._history_cache.popitem(last=False)
+        return page
 
     def requests_since(self, user_id: int, since: datetime.datetime) -> Sequence[RecentReq]:
         with Session(self.engine) as session:
@@ -47,9 +147,17 @@ class RecentDB:
             return results.all()
 
     def count_pending(self) -> int:
+        if self.pending is None:
+            return self.recount_pending()
+        return self.pending
+
+    def recount_pending(self) -> int:
+        # other bot instances change the count too, so this needs calling
+        # now and then to catch up with them
         with Session(self.engine) as session:
             results = session.exec(select(sa.func.count()).where(RecentReq.completed == None))
-            return results.one()
+            self.pending = results.one()
+            return self.pending
 
     def add_request(self, req : RecentReq):
         assert req.completed is None
@@ -57,11 +165,113 @@ class RecentDB:
             session.add(req)
             session.commit()
             session.refresh(req)
+        if self.pending is not None:
+            self.pending += 1
+        self._invalidate_history([req.user_id])
 
     def complete_requests(self, filetxids : List[Tuple[str, Optional[str]]]):
         now = utcnow()
         with Session(self.engine) as session:
+            user_ids = []
             for file, txid in filetxids:
-                session.execute(update(RecentReq).where(RecentReq.filename == file).values(completed=now, txid=txid))
+                result = session.execute(update(RecentReq).where(RecentReq.filename == file).where(RecentReq.completed == None).values(completed=now, txid=txid).returning(RecentReq.user_id))
+                user_ids.extend(result.scalars())
+            session.commit()
+        if self.pending is not None:
+            self.pending = max(0, self.pending - len(user_ids))
+        self._invalidate_history(user_ids)
+
+
+    def _archive_rows(self, rows : Sequence[RecentReq]):
+        # one gzipped file of json lines per month of completion; appending
+        # just adds another gzip member
+        months = {}
+        for r in rows:
+            months.setdefault(r.completed.strftime("%Y-%m"), []).append(r)
+        self.archive.mkdir(parents=True, exist_ok=True)
+        for month, mrows in months.items():
+            with gzip.open(self.archive / f"recent-{month}.jsonl.gz", "at") as f:
+                for r in mrows:
+                    d = r.model_dump()
+                    d["timestamp"] = fromtime(r.timestamp)
+                    d["completed"] = fromtime(r.completed)
+                    f.write(json.dumps(d) + "\n")
+
+    def prune_batch(self, cutoff : datetime.datetime, batch : int = PRUNE_BATCH) -> int:
+        with Session(self.engine) as session:
+            rows = session.exec(select(RecentReq).where(RecentReq.completed < cutoff).order_by(RecentReq.completed).limit(batch)).all()
+            if not rows:
+                return 0
+            if self.archive is not None:
+                self._archive_rows(rows)
+            user_ids = {r.user_id for r in rows}
+            session.execute(sa.delete(RecentReq).where(RecentReq.id.in_([r.id for r in rows])))
             session.commit()
+        self._invalidate_history(user_ids)
+        return len(rows)
+
+    def prune(self, cutoff : datetime.datetime, batch : int = PRUNE_BATCH) -> int:
+        total = 0
+        while (n := self.prune_batch(cutoff, batch)) > 0:
+            total += n
+            if n < batch: break
+        return total
+
+    def vacuum(self, pages : int = VACUUM_PAGES):
+        # sqlite frees one page per step of this pragma, and the sqlite3
+        # module only steps it once via execute(), so use executescript()
+        conn = self.engine.raw_connection()
+        try:
+            conn.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        finally:
+            conn.close()
+
+class AsyncRecentDB:
+    # Runs RecentDB off the asyncio event loop: writes are serialised
+    # through a single thread, reads go to a small pool so they can run
+    # alongside each other and alongside a write.
+    def __init__(self, echo=False, readers=4):
+        self.db = RecentDB(echo=echo)
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="recentdb-write")
+        self._readers = concurrent.futures.ThreadPoolExecutor(max_workers=readers, thread_name_prefix="recentdb-read")
+
+    async def _run(self, executor, fn, *args):
+        with QUERY_SECONDS.time(query=fn.__name__):
+            return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args))
+
+    async def history(self, user_id: int, limit: int = HISTORY_LIMIT) -> Sequence[RecentReq]:
+        return await self._run(self._readers, self.db.history, user_id, limit)
+
+    async def history_page(self, user_id: int, before: Optional[HistoryKey] = None, after: Optional[HistoryKey] = None, limit: int = HISTORY_PAGE) -> HistoryPage:
+        return await self._run(self._readers, self.db.history_page, user_id, before, after, limit)
+
+    async def requests_since(self, user_id: int, since: datetime.datetime) -> Sequence[RecentReq]:
+        return await self._run(self._readers, self.db.requests_since, user_id, since)
+
+    async def count_pending(self) -> int:
+        if self.db.pending is not None:
+            return self.db.pending
+        return await self._run(self._writer, self.db.recount_pending)
+
+    async def recount_pending(self) -> int:
+        # on the writer, so it can't interleave with the adds and
+        # completions that adjust the count
+        return await self._run(self._writer, self.db.recount_pending)
+
+    async def add_request(self, req : RecentReq):
+        return await self._run(self._writer, self.db.add_request, req)
+
+    async def complete_requests(self, filetxids : List[Tuple[str, Optional[str]]]):
+        return await self._run(self._writer, self.db.complete_requests, filetxids)
+
+    async def prune(self, cutoff : datetime.datetime, batch : int = PRUNE_BATCH) -> int:
+        # each batch is queued separately, so requests being added aren't
+        # stuck behind the whole prune
+        total = 0
+        while (n := await self._run(self._writer, self.db.prune_batch, cutoff, batch)) > 0:
+            total += n
+            if n < batch: break
+        return total
 
+    async def vacuum(self, pages : int = VACUUM_PAGES):
+        return await self._run(self._writer, self.db.vacuum, pages)
@@ -1,29 +1,58 @@
 #!/usr/bin/env python3
 
-from typing import List, Optional
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 import datetime
 import hashlib
 import json
+import logging
 import os
 import pathlib
 import re
+import struct
+import sys
+import time
+import zlib
 
 import discord
+import sqlalchemy as sa
+from sqlmodel import SQLModel, Field
 
-from timestuff import utcnow, fromtime, totime
+import dirwatch
+from faucetdb import chunked, make_engine, migrate
+from sqlalchemytime import IntTimeStamp
+
+from timestuff import utcnow, fromtime
 
 CURRENT = "./requests/current"
 COMPLETE = "./requests/complete"
 
+# Where requests wait for the worker: "files" keeps each one as a file in
+# requests/current, "queue" keeps them in the requests/queue.sqlite db.
+# Drain the queue before switching, as neither reads the other's.
+BACKEND = "files"
+QUEUE_DB = "sqlite:///./requests/queue.sqlite"
+QUEUE_POLL_INTERVAL = 0.25
+
+# leave a day's directory alone for this long before packing it, since
+# requests are filed by the day they were made, not completed
+COMPACT_AFTER = datetime.timedelta(days=2)
+
 class Requests:
     RE_FILE = re.compile(r"^\d+-\d+[.]\d+-([0-9a-f]{64})[.]json")
 
     def __init__(self):
         self._current = pathlib.Path(CURRENT)
         self._complete = pathlib.Path(COMPLETE)
+        # filename -> ((inode, mtime, size), parsed request or None if invalid)
+        self._cache : Dict[str, Tuple[Tuple[int, int, int], Optional[dict]]] = {}
+        self._made_dirs : Set[pathlib.Path] = set()
+        # index path -> (mtime, index)
+        self._indexes : Dict[pathlib.Path, Tuple[int, dict]] = {}
 
-    def create(self, interaction: discord.Interaction, address: str) -> Optional[dict]:
+    @staticmethod
+    def _encode(interaction: discord.Interaction, address: str) -> Tuple[dict, bytes, str]:
+        # the request, its bytes, and its name, which embeds their hash
         t = fromtime(utcnow())
         d = dict(timestamp=t,
                  interaction_id=interaction.id,
@@ -34,7 +63,11 @@ class Requests:
                  address=address)
         j = json.dumps(d).encode('utf8')
         h = hashlib.sha256(j).hexdigest()
-        filename = self._current / (t + "-" + h + ".json")
+        return d, j, t + "-" + h + ".json"
+
+    def create(self, interaction: discord.Interaction, address: str) -> Optional[dict]:
+        d, j, name = self._encode(interaction, address)
+        filename = self._current / name
         try:
             with filename.open("xb") as f:
                 f.write(j)
@@ -43,35 +76,325 @@ class Requests:
         except FileExistsError:
             return None
 
+    def watcher(self) -> dirwatch.DirWatcher:
+        # wakes the worker when a request is created
+        return dirwatch.DirWatcher(CURRENT)
+
+    def _verify(self, path : str, name : str) -> Optional[dict]:
+        with open(path, "rb") as f:
+            return self._parse(name, f.read())
+
     def read(self) -> List[dict]:
+        # only files that are new or have changed since the last call are
+        # read and hashed; everything else comes from the cache
         result = []
-        for fname in self._current.iterdir():
-             m = self.RE_FILE.match(fname.name)
-             if m is None:
-                 continue
-             d = fname.read_bytes()
-             h = hashlib.sha256(d).hexdigest()
-             if h != m.group(1):
-                 continue
-             s = json.loads(d.decode('utf8'))
-             if not isinstance(s, dict):
-                 continue
-             s["filename"] = fname.name
-             result.append(s)
+        cache = {}
+        with os.scandir(self._current) as it:
+            for entry in it:
+                if self.RE_FILE.match(entry.name) is None:
+                    continue
+                try:
+                    st = entry.stat()
+                    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+                    cached = self._cache.get(entry.name)
+                    if cached is not None and cached[0] == key:
+                        s = cached[1]
+                    else:
+                        s = self._verify(entry.path, entry.name)
+                except (OSError, ValueError):
+                    continue
+                cache[entry.name] = (key, s)
+                if s is not None:
+                    result.append(s)
+        self._cache = cache
+        return result
+
+    def _day_dir(self, fname : str) -> pathlib.Path:
+        # filenames start with the request's timestamp, YYYYMMDD-HHMMSS...
+        return self._complete / fname[0:4] / (fname[4:6] + "-" + fname[6:8])
+
+    def _complete_dir(self, fname : str) -> pathlib.Path:
+        d = self._day_dir(fname)
+        if d not in self._made_dirs:
+            d.mkdir(parents=True, exist_ok=True)
+            self._made_dirs.add(d)
+        return d
+
+    def complete_many(self, fnames : Iterable[str]) -> Dict[str, bool]:
+        result = {}
+        for fname in fnames:
+            result[fname] = False
+            if self.RE_FILE.match(fname) is None:
+                continue
+            src = self._current / fname
+            for attempt in (0, 1):
+                d = self._complete_dir(fname)
+                try:
+                    src.rename(d / fname)
+                    self._cache.pop(fname, None)
+                    result[fname] = True
+                except FileNotFoundError:
+                    # either the request was already completed, or the
+                    # day directory went away since we created it
+                    if attempt == 0 and src.exists():
+                        self._made_dirs.discard(d)
+                        continue
+                except OSError as e:
+                    logging.warning(f"could not complete {fname}: {e}")
+                break
         return result
 
     def complete(self, fname : str) -> bool:
+        return self.complete_many([fname])[fname]
+
+    # Finished day directories can be packed into a segment, YYYY/MM-DD.seg,
+    # holding each request file's original bytes zlib-compressed, prefixed
+    # by a 4-byte big-endian length. Records are only ever appended. The
+    # sidecar YYYY/MM-DD.idx maps filenames to offsets, and user ids to
+    # the offsets of their requests.
+
+    def compact(self, now : Optional[datetime.datetime] = None) -> int:
+        if now is None: now = utcnow()
+        cutoff = (now - COMPACT_AFTER).strftime("%Y/%m-%d")
+        n = 0
+        for year in sorted(self._complete.glob("[0-9][0-9][0-9][0-9]")):
+            for day in sorted(year.glob("[0-9][0-9]-[0-9][0-9]")):
+                if day.is_dir() and f"{year.name}/{day.name}" < cutoff:
+                    n += self.compact_day(day)
+        return n
+
+    def compact_day(self, day : pathlib.Path) -> int:
+        files = sorted(p for p in day.iterdir() if self.RE_FILE.match(p.name))
+        added = self._pack(day, ((p.name, p.read_bytes()) for p in files))
+        for p in files:
+            p.unlink()
         try:
-            src = self._current / fname
-            d = json.loads(src.read_text())
-            dt = totime(d["timestamp"])
-            dest = self._complete / str(dt.year) / ("%02d-%02d" % (dt.month, dt.day)) / fname
-            dest.parent.mkdir(parents=True, exist_ok=True)
-            src.rename(dest)
-            return True
-        except:
-            return False
+            day.rmdir()
+        except OSError:
+            pass # something was completed into it meanwhile
+        return added
+
+    def _pack(self, day : pathlib.Path, records : Iterable[Tuple[str, bytes]]) -> int:
+        # append (filename, bytes) records to the day's segment, skipping
+        # any it already has, and only return once they're on disk
+        seg, idxpath = day.with_suffix(".seg"), day.with_suffix(".idx")
+        seg.parent.mkdir(parents=True, exist_ok=True)
+        index = self._load_index(idxpath) or dict(files={}, users={})
+        added = 0
+        with open(seg, "ab") as f:
+            for name, data in records:
+                if name in index["files"]:
+                    continue
+                z = zlib.compress(data, 9)
+                offset = f.tell()
+                f.write(struct.pack(">I", len(z)) + z)
+                index["files"][name] = offset
+                try:
+                    user_id = str(json.loads(data)["user_id"])
+                    index["users"].setdefault(user_id, []).append(offset)
+                except (ValueError, KeyError, TypeError):
+                    pass
+                added += 1
+            f.flush()
+            os.fsync(f.fileno())
+        tmp = idxpath.with_suffix(".idx.tmp")
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        tmp.rename(idxpath)
+        return added
+
+    def _load_index(self, idxpath : pathlib.Path) -> Optional[dict]:
+        try:
+            mtime = idxpath.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+        cached = self._indexes.get(idxpath)
+        if cached is None or cached[0] != mtime:
+            with open(idxpath) as f:
+                cached = (mtime, json.load(f))
+            self._indexes[idxpath] = cached
+        return cached[1]
+
+    @staticmethod
+    def _read_record(seg : pathlib.Path, offset : int) -> bytes:
+        with open(seg, "rb") as f:
+            f.seek(offset)
+            n, = struct.unpack(">I", f.read(4))
+            return zlib.decompress(f.read(n))
+
+    def _parse(self, fname : str, data : bytes) -> Optional[dict]:
+        m = self.RE_FILE.match(fname)
+        if m is None or hashlib.sha256(data).hexdigest() != m.group(1):
+            return None
+        s = json.loads(data.decode('utf8'))
+        if not isinstance(s, dict):
+            return None
+        s["filename"] = fname
+        return s
+
+    def read_complete(self, fname : str) -> Optional[dict]:
+        # looks up a completed request, whether or not its day has been
+        # packed yet, re-verifying its hash
+        if self.RE_FILE.match(fname) is None:
+            return None
+        day = self._day_dir(fname)
+        try:
+            return self._parse(fname, (day / fname).read_bytes())
+        except FileNotFoundError:
+            pass
+        index = self._load_index(day.with_suffix(".idx"))
+        if index is None or fname not in index["files"]:
+            return None
+        return self._parse(fname, self._read_record(day.with_suffix(".seg"), index["files"][fname]))
+
+    def read_complete_user(self, user_id : int) -> List[dict]:
+        # completed requests by a user, from packed days only
+        result = []
+        for idxpath in sorted(self._complete.glob("[0-9][0-9][0-9][0-9]/[0-9][0-9]-[0-9][0-9].idx")):
+            index = self._load_index(idxpath)
+            if index is None: continue
+            offsets = set(index["users"].get(str(user_id), []))
+            if not offsets: continue
+            for fname, offset in index["files"].items():
+                if offset in offsets:
+                    s = self._parse(fname, self._read_record(idxpath.with_suffix(".seg"), offset))
+                    if s is not None:
+                        result.append(s)
+        return result
+
+class QueuedRequest(SQLModel, table=True):
+    __tablename__ = "queue"
+    # autoincrement, so seqs are never reused once compact() deletes rows
+    __table_args__ = (sa.Index("idx_queue_pending", "seq", sqlite_where=sa.text("completed IS NULL")),
+                      {"sqlite_autoincrement": True},
+                     )
+
+    seq: int | None = Field(default=None, primary_key=True)
+    filename: str = Field(unique=True)
+    data: bytes   # the request's json, exactly as hashed in its filename
+    completed: Optional[datetime.datetime] = Field(default=None, sa_column=sa.Column(IntTimeStamp()))
+
+def _queue_schema_v1(conn):
+    SQLModel.metadata.create_all(conn, tables=[QueuedRequest.__table__])
+
+# see faucetdb.migrate
+QUEUE_MIGRATIONS = [_queue_schema_v1]
+
+class QueueRequests(Requests):
+    # Requests kept as rows of a single db rather than as files: creating
+    # one is a single insert, the worker only reads rows added since its
+    # last look, and completing a batch is one transaction. compact()
+    # exports completed requests into the same segments as the file
+    # backend, and then deletes them.
+    def __init__(self):
+        super().__init__()
+        self.engine = make_engine(QUEUE_DB)
+        migrate(self.engine, QUEUE_MIGRATIONS)
+        # seq -> parsed request, or None if it failed verification
+        self._pending : Dict[int, Optional[dict]] = {}
+        self._last_seq = 0
+
+    def create(self, interaction: discord.Interaction, address: str) -> Optional[dict]:
+        d, j, name = self._encode(interaction, address)
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(sa.insert(QueuedRequest.__table__).values(filename=name, data=j))
+        except sa.exc.IntegrityError:
+            return None
+        d["filename"] = name
+        return d
+
+    def last_seq(self) -> int:
+        qt = QueuedRequest.__table__
+        with self.engine.connect() as conn:
+            return conn.execute(sa.select(sa.func.max(qt.c.seq))).scalar() or 0
+
+    def watcher(self) -> "QueueWatcher":
+        return QueueWatcher(self)
+
+    def read(self) -> List[dict]:
+        qt = QueuedRequest.__table__
+        with self.engine.connect() as conn:
+            # new rows first: anything added between the two queries is
+            # simply picked up next time
+            new = conn.execute(sa.select(qt.c.seq, qt.c.filename, qt.c.data).where(qt.c.seq > self._last_seq).where(qt.c.completed == None).order_by(qt.c.seq))
+            for seq, fname, data in new:
+                try:
+                    self._pending[seq] = self._parse(fname, data)
+                except ValueError:
+                    self._pending[seq] = None
+                self._last_seq = seq
+            pending = set(conn.execute(sa.select(qt.c.seq).where(qt.c.completed == None)).scalars())
+        for seq in [seq for seq in self._pending if seq not in pending]:
+            del self._pending[seq]
+        return [s for _, s in sorted(self._pending.items()) if s is not None]
+
+    def complete_many(self, fnames : Iterable[str]) -> Dict[str, bool]:
+        qt = QueuedRequest.__table__
+        result = {}
+        now = utcnow()
+        with self.engine.begin() as conn:
+            for fname in fnames:
+                r = conn.execute(sa.update(qt).where(qt.c.filename == fname).where(qt.c.completed == None).values(completed=now))
+                result[fname] = r.rowcount > 0
+        return result
+
+    def compact(self, now : Optional[datetime.datetime] = None) -> int:
+        # also packs any day directories left by the file backend
+        n = super().compact(now)
+        if now is None: now = utcnow()
+        cutoff = (now - COMPACT_AFTER).strftime("%Y%m%d")
+        qt = QueuedRequest.__table__
+        with self.engine.connect() as conn:
+            days = conn.execute(sa.select(sa.func.substr(qt.c.filename, 1, 8)).distinct().where(qt.c.completed != None).where(qt.c.filename < cutoff)).scalars().all()
+        for ymd in sorted(days):
+            with self.engine.connect() as conn:
+                rows = conn.execute(sa.select(qt.c.seq, qt.c.filename, qt.c.data).where(qt.c.completed != None).where(qt.c.filename.startswith(ymd + "-")).order_by(qt.c.filename)).all()
+            n += self._pack(self._day_dir(ymd), ((fname, data) for _, fname, data in rows))
+            with self.engine.begin() as conn:
+                for chunk in chunked(seq for seq, _, _ in rows):
+                    conn.execute(sa.delete(qt).where(qt.c.seq.in_(chunk)))
+        return n
+
+    def read_complete(self, fname : str) -> Optional[dict]:
+        # completed requests stay in the queue until compacted
+        qt = QueuedRequest.__table__
+        with self.engine.connect() as conn:
+            data = conn.execute(sa.select(qt.c.data).where(qt.c.filename == fname).where(qt.c.completed != None)).scalar()
+        if data is not None:
+            return self._parse(fname, data)
+        return super().read_complete(fname)
+
+class QueueWatcher:
+    # DirWatcher's interface for the queue, waking when a request is added
+    def __init__(self, queue : QueueRequests, poll_interval : float = QUEUE_POLL_INTERVAL):
+        self._queue = queue
+        self._poll_interval = poll_interval
+        self._seq = queue.last_seq()
+
+    def clear(self) -> None:
+        self._seq = self._queue.last_seq()
+
+    def wait(self, timeout : float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            seq = self._queue.last_seq()
+            if seq > self._seq:
+                self._seq = seq
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self._poll_interval, remaining))
+
+def open_requests() -> Requests:
+    return QueueRequests() if BACKEND == "queue" else Requests()
 
 if __name__ == "__main__":
-    for r in Requests().read():
-        print(r)
+    if sys.argv[1:] == ["compact"]:
+        print(f"packed {open_requests().compact()} completed requests")
+    else:
+        for r in open_requests().read():
+            print(r)
@@ -1,19 +1,29 @@
 #!/usr/bin/env python3
 
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 import dataclasses
+import fcntl
 import datetime
 import decimal
 import json
 import os
+import pathlib
+import re
+import time
 
 from timestuff import totime, fromtime
 
 FILE_STATUS = "./payouts/status.json"
 FILE_STATUS_TMP = "./payouts/status.json.tmp"
+EVENTS_DIR = "./payouts/events"
+EVENTS_SEGMENT_SIZE = 4 * 1024 * 1024
+# full segments last written this long ago are deleted; a reader further
+# behind than this misses those events, but the worker journals requests
+# that are still pending again anyway
+EVENTS_RETENTION = datetime.timedelta(days=7)
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True)
 class Status:
     last_check: datetime.datetime
     request_frequency: datetime.timedelta
@@ -21,6 +31,11 @@ class Status:
     faucet_address: str
     current_payouts: Dict[str, List[str]]  # txid to list of filenames
     current_rejects: List[str] # list of filenames
+    # what the worker pays, to project the cost of the requests pending;
+    # 0 if unknown
+    btc_per_tx: decimal.Decimal = decimal.Decimal(0)  # most paid by one payout
+    btc_per_out: decimal.Decimal = decimal.Decimal(0) # most paid per request
+    outputs_per_tx: int = 0                           # fewest requests a full payout holds
 
     @classmethod
     def from_json(cls, jsondata):
@@ -32,6 +47,9 @@ class Status:
             faucet_address=d["faucet_address"],
             current_payouts=d["current_payouts"],
             current_rejects=d["current_rejects"],
+            btc_per_tx=decimal.Decimal(d.get("btc_per_tx", 0)),
+            btc_per_out=decimal.Decimal(d.get("btc_per_out", 0)),
+            outputs_per_tx=d.get("outputs_per_tx", 0),
         )
 
     def to_json(self) -> str:
@@ -39,15 +57,196 @@ class Status:
         d["last_check"] = fromtime(d["last_check"])
         d["request_frequency"] = d["request_frequency"].total_seconds()
         d["faucet_balance"] = str(d["faucet_balance"])
+        d["btc_per_tx"] = str(d["btc_per_tx"])
+        d["btc_per_out"] = str(d["btc_per_out"])
         return json.dumps(d)
 
+    def payout_cost(self, n : int) -> decimal.Decimal:
+        # the most that paying n requests can cost, 0 if unknown
+        cost = n * self.btc_per_out
+        if self.btc_per_tx > 0 and self.outputs_per_tx > 0:
+            cost = min(cost, -(-n // self.outputs_per_tx) * self.btc_per_tx)
+        return cost
+
     def write(self) -> None:
-        f = open(FILE_STATUS_TMP, "w")
+        # per process, as several workers may be writing at once
+        tmp = f"{FILE_STATUS_TMP}.{os.getpid()}"
+        f = open(tmp, "w")
         f.write(self.to_json())
         f.flush()
         f.close()
-        os.rename(FILE_STATUS_TMP, FILE_STATUS)
+        os.rename(tmp, FILE_STATUS)
 
     @classmethod
     def read(cls):
         return cls.from_json(open(FILE_STATUS, "r").read())
+
+class StatusReader:
+    # Caches the parsed status file, only re-reading it after the worker
+    # has replaced it (ie, when its inode, mtime or size changes).
+    def __init__(self, filename : str = FILE_STATUS):
+        self._filename = filename
+        self._key : Optional[Tuple[int, int, int]] = None
+        self._status : Optional[Status] = None
+
+    def read(self) -> Status:
+        try:
+            st = os.stat(self._filename)
+        except OSError:
+            if self._status is not None:
+                return self._status
+            raise
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if self._status is None or key != self._key:
+            with open(self._filename, "r") as f:
+                self._status = Status.from_json(f.read())
+            self._key = key
+        return self._status
+
+@dataclasses.dataclass(frozen=True)
+class Event:
+    seq: int
+    timestamp: datetime.datetime
+    txid: Optional[str]    # None if the requests were rejected
+    filenames: List[str]
+
+    @classmethod
+    def from_json(cls, jsondata):
+        d = json.loads(jsondata)
+        return cls(
+            seq=d["seq"],
+            timestamp=totime(d["timestamp"]),
+            txid=d["txid"],
+            filenames=d["filenames"],
+        )
+
+    def to_json(self) -> str:
+        return json.dumps(dict(seq=self.seq, timestamp=fromtime(self.timestamp), txid=self.txid, filenames=self.filenames))
+
+# The event log is a directory of append-only segments of JSON lines, one
+# event per line, each segment named after the seq of its first event.
+RE_SEGMENT = re.compile(r"^(\d{16})[.]jsonl$")
+
+def _segments(path : pathlib.Path) -> List[str]:
+    try:
+        return sorted(n for n in os.listdir(path) if RE_SEGMENT.match(n))
+    except FileNotFoundError:
+        return []
+
+def _segment_name(seq : int) -> str:
+    return "%016d.jsonl" % (seq,)
+
+class EventLog:
+    # Several payout workers may append to the same log, so appends are
+    # serialised with a lock file, and each first catches up with any
+    # events the others have written.
+    def __init__(self, path : str = EVENTS_DIR, segment_size : int = EVENTS_SEGMENT_SIZE, retention : datetime.timedelta = EVENTS_RETENTION):
+        self._path = pathlib.Path(path)
+        self._path.mkdir(parents=True, exist_ok=True)
+        self._segment_size = segment_size
+        self._retention = retention
+        self._lock = self._path / "lock"
+        self._segment : Optional[str] = None
+        self._offset = 0
+        self.next_seq = 1
+        self._catch_up()
+
+    def _catch_up(self) -> None:
+        segs = _segments(self._path)
+        if not segs:
+            return
+        if self._segment not in segs:
+            self._segment = segs[-1]
+            self._offset = 0
+            self.next_seq = max(self.next_seq, int(RE_SEGMENT.match(self._segment).group(1)))
+        for seg in segs[segs.index(self._segment):]:
+            if seg != self._segment:
+                self._segment = seg
+                self._offset = 0
+            with open(self._path / seg, "rb") as f:
+                f.seek(self._offset)
+                data = f.read()
+            self._offset += len(data)
+            for line in data.split(b"\n"):
+                if line:
+                    self.next_seq = max(self.next_seq, json.loads(line)["seq"] + 1)
+
+    def append(self, timestamp : datetime.datetime, txid : Optional[str], filenames : List[str]) -> int:
+        with open(self._lock, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._catch_up()
+            seq = self.next_seq
+            if self._segment is None or self._offset >= self._segment_size:
+                self._segment = _segment_name(seq)
+                self._offset = 0
+                self._prune()
+            line = Event(seq=seq, timestamp=timestamp, txid=txid, filenames=filenames).to_json() + "\n"
+            with open(self._path / self._segment, "a") as f:
+                f.write(line)
+            self._offset += len(line.encode('utf8'))
+            self.next_seq = seq + 1
+        return seq
+
+    def _prune(self) -> None:
+        # called with the lock held, when starting a new segment
+        cutoff = time.time() - self._retention.total_seconds()
+        for seg in _segments(self._path):
+            if seg == self._segment:
+                continue
+            try:
+                if os.stat(self._path / seg).st_mtime < cutoff:
+                    os.unlink(self._path / seg)
+            except FileNotFoundError:
+                pass
+
+class EventReader:
+    # Returns events from the log with seq greater than the cursor. If a
+    # cursor file is given, the cursor is loaded from it, and saved there
+    # by commit().
+    def __init__(self, cursor_file : Optional[str] = None, path : str = EVENTS_DIR):
+        self._path = pathlib.Path(path)
+        self._cursor_file = cursor_file
+        self.cursor = 0
+        if cursor_file is not None and os.path.exists(cursor_file):
+            self.cursor = int(open(cursor_file).read().strip())
+        self._segment : Optional[str] = None
+        self._offset = 0
+
+    def read(self) -> List[Event]:
+        segs = _segments(self._path)
+        if not segs:
+            return []
+        if self._segment not in segs:
+            # start from the last segment beginning at or before the cursor
+            self._segment = segs[0]
+            for seg in segs:
+                if int(RE_SEGMENT.match(seg).group(1)) <= self.cursor + 1:
+                    self._segment = seg
+            self._offset = 0
+
+        result = []
+        for seg in segs[segs.index(self._segment):]:
+            if seg != self._segment:
+                self._segment = seg
+                self._offset = 0
+            with open(self._path / seg, "rb") as f:
+                f.seek(self._offset)
+                data = f.read()
+            end = data.rfind(b"\n") + 1
+            self._offset += end
+            for line in data[:end].split(b"\n"):
+                if not line:
+                    continue
+                e = Event.from_json(line)
+                if e.seq > self.cursor:
+                    result.append(e)
+                    self.cursor = e.seq
+        return result
+
+    def commit(self) -> None:
+        if self._cursor_file is None:
+            return
+        tmp = self._cursor_file + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(f"{self.cursor}\n")
+        os.rename(tmp, self._cursor_file)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+# Counters, gauges and latency histograms, exported in the Prometheus text
+# format, either to a file or over HTTP. Metrics are declared at import
+# time, but record nothing until enable() is called, so the cost when
+# disabled is a single flag check.
+
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+import bisect
+import contextlib
+import http.server
+import os
+import threading
+import time
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_enabled = False
+_metrics : List["Metric"] = []
+
+def enable() -> None:
+    global _enabled
+    _enabled = True
+
+def _escape(v : str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labelstr(names : Sequence[str], values : Tuple[str, ...], extra : str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Metric:
+    TYPE = ""
+
+    def __init__(self, name : str, help : str, labels : Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels : Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "".join([f"# HELP {self.name} {self.help}\n", f"# TYPE {self.name} {self.TYPE}\n"] + [s + "\n" for s in self.samples()])
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def __init__(self, name : str, help : str, labels : Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values : Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount : float = 1, **labels) -> None:
+        if not _enabled: return
+        k = self._key(labels)
+        with self._lock:
+            self._values[k] = self._values.get(k, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for k, v in values:
+            yield f"{self.name}{_labelstr(self.labelnames, k)} {v}"
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+    def set(self, value : float, **labels) -> None:
+        if not _enabled: return
+        k = self._key(labels)
+        with self._lock:
+            self._values[k] = value
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name : str, help : str, labels : Sequence[str] = (), buckets : Sequence[float] = BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # label values -> (count per bucket, plus +Inf), sum
+        self._values : Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value : float, **labels) -> None:
+        if not _enabled: return
+        k = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(k) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[i] += 1
+            self._values[k] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        if not _enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted((k, (list(c), s)) for k, (c, s) in self._values.items())
+        for k, (counts, total) in values:
+            cumulative = 0
+            for b, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                le = 'le="+Inf"' if b == float("inf") else f'le="{b!r}"'
+                yield f"{self.name}_bucket{_labelstr(self.labelnames, k, le)} {cumulative}"
+            yield f"{self.name}_sum{_labelstr(self.labelnames, k)} {total}"
+            yield f"{self.name}_count{_labelstr(self.labelnames, k)} {cumulative}"
+
+def render() -> str:
+    return "".join(m.render() for m in _metrics)
+
+def write(filename : str) -> None:
+    if not _enabled: return
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(render())
+    os.rename(tmp, filename)
+
+def serve(port : int, host : str = "127.0.0.1") -> http.server.ThreadingHTTPServer:
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            data = render().encode('utf8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,100 +1,262 @@
 #!/usr/bin/env python3
 
-from typing import Dict, List, Set
+from typing import Dict, List, Optional, Set, Tuple, Union
 
+import concurrent.futures
 import datetime
 import decimal
-import json
 import logging
+import os
 import re
-import subprocess
-import sys
+import socket
 import time
 
+import bitcoinaddr
+import bitcoinrpc
 import faucetpayouts
 import faucetrequests
 import faucetstatus
+import metrics
+import utxopool
 
 from timestuff import utcnow, totime
 
-CMD=f"bitcoin-cli -rpcwallet= -signet"
+WALLET=""
+METRICS_FILE="./payouts/metrics.prom"
 
+# keep the outputs of a payout well under the standardness limit of
+# 400000 weight units (100000 vbytes), leaving room for inputs and change
+MAX_PAYOUT_VSIZE=90000
+# BTC_PER_TX is shared among a payout's outputs, so this keeps each
+# output's share from shrinking as the backlog grows
 MAX_PER_TX=500
+# the fewest outputs a full payout holds, if each pays to the largest
+# scriptPubKey an address can have (a 40 byte witness program)
+OUTPUTS_PER_TX = min(MAX_PER_TX, MAX_PAYOUT_VSIZE // (9 + 42))
+# stay clear of the mempool's limit of 25 unconfirmed ancestors, as each
+# payout may spend the previous one's change
+MAX_TX_PER_CYCLE=10
 BTC_PER_TX=decimal.Decimal("0.05")
 BTC_PER_OUT=decimal.Decimal("0.025")
 QUANTIZE=decimal.Decimal(10)**-5
 BTC_MIN = decimal.Decimal("0.00001")
 
+# confirmed coins to keep ready for funding payouts (0 to let the wallet
+# choose coins for each payout instead), each big enough for any payout
+POOL_TARGET = 20
+POOL_COIN = BTC_PER_TX + decimal.Decimal("0.01")
+
 REQUEST_FREQUENCY = datetime.timedelta(hours=1)
 BALANCE_FREQUENCY = datetime.timedelta(minutes=30)
 PAYOUT_FREQUENCY = datetime.timedelta(minutes=1)
+BATCH_WINDOW = datetime.timedelta(seconds=2)
+MIN_TX_INTERVAL = datetime.timedelta(seconds=5)
+POOL_FREQUENCY = datetime.timedelta(minutes=10)
+# write a request's outcome to the event log again if it is still waiting
+# to be completed this long after, eg because the bot failed to move it,
+# doubling the wait each time up to REJOURNAL_MAX
+REJOURNAL_AFTER = datetime.timedelta(minutes=5)
+REJOURNAL_MAX = datetime.timedelta(hours=6)
+
+# Several workers may share requests/ and payouts/; each leases the users
+# whose requests it is handling in audit.sqlite. A lease outlives any
+# normal cycle, and only matters if its worker dies mid-cycle.
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+LEASE_TIME = datetime.timedelta(minutes=15)
+CLAIM_CHUNK = 1000
+
+PHASE_SECONDS = metrics.Histogram("faucet_worker_phase_seconds", "Time spent in each phase of a payout cycle", ["phase"])
+REQUESTS = metrics.Counter("faucet_worker_requests_total", "Requests handled, by outcome", ["outcome"])
+PAYOUTS = metrics.Counter("faucet_worker_payouts_total", "Payout transactions attempted, by result", ["result"])
+BACKLOG = metrics.Gauge("faucet_worker_backlog", "Requests in requests/current at the start of the last cycle")
+POOL_COINS = metrics.Gauge("faucet_worker_pool_coins", "Confirmed coins in the utxo pool after the last maintenance")
+
+RPC_WALLET_INSUFFICIENT_FUNDS = -6
+RPC_VERIFY_REJECTED = -26
+
+def output_error(e : bitcoinrpc.RPCError) -> bool:
+    # whether a failed payout can be blamed on (some of) its outputs
+    if e.method == "createrawtransaction":
+        return True
+    return e.code == RPC_VERIFY_REJECTED and ("dust" in e.message or "scriptpubkey" in e.message)
 
 class Worker:
     RE_TXID = re.compile(r'^[0-9a-f]{64}$')
 
     def __init__(self):
-        self.reqs = faucetrequests.Requests()
+        self.reqs = faucetrequests.open_requests()
         self.paid = faucetpayouts.PayoutDB()
+        self.rpc = bitcoinrpc.RPC(wallet=WALLET)
+        # used by the thread funding the next payout while the current one
+        # is signed and sent
+        self.fund_rpc = bitcoinrpc.RPC(wallet=WALLET)
         self.balance = decimal.Decimal(0)
         self.balance_bump = utcnow()
+        self.pool = utxopool.UTXOPool(self.rpc, POOL_TARGET, POOL_COIN) if POOL_TARGET > 0 else None
+        self.pool_bump = utcnow()
+        self.last_tx = utcnow() - MIN_TX_INTERVAL
+        self.events = faucetstatus.EventLog()
+        # when outcomes should next be written to the event log, and the
+        # wait before that, for requests still in requests/current
+        self.journaled : Dict[str, Tuple[datetime.datetime, datetime.timedelta]] = {}
+        # userid -> timestamp of their last paid request, for users who
+        # are still rate limited; audit.sqlite remains authoritative
+        self.last_paid : Dict[int, datetime.datetime] = self.paid.recent_payouts(utcnow() - REQUEST_FREQUENCY)
 
     def get_balance(self):
         n = utcnow()
         if n >= self.balance_bump:
             self.balance_bump = n + BALANCE_FREQUENCY
-            b = subprocess.run(f"{CMD} getbalance", shell=True, capture_output=True)
-            if b.returncode == 0:
-                self.balance = decimal.Decimal(b.stdout.strip().decode('utf8'))
+            try:
+                if self.pool is not None:
+                    self.pool.refresh()
+                    self.balance = self.pool.balance
+                else:
+                    self.balance = self.rpc.getbalance()
+            except bitcoinrpc.RPCError as e:
+                logging.warning(f"could not update balance: {e}")
         return self.balance
 
+    def maintain_pool(self) -> None:
+        n = utcnow()
+        if self.pool is None or n < self.pool_bump:
+            return
+        self.pool_bump = n + POOL_FREQUENCY
+        with PHASE_SECONDS.time(phase="pool"):
+            try:
+                self.pool.maintain()
+            except bitcoinrpc.RPCError as e:
+                logging.warning(f"could not maintain utxo pool: {e}")
+                return
+        # maintain() has just listed the wallet's coins
+        self.balance = self.pool.balance
+        self.balance_bump = n + BALANCE_FREQUENCY
+        POOL_COINS.set(len(self.pool))
+
     def loop(self):
+        watcher = self.reqs.watcher()
         while True:
-            self.dowork()
-            time.sleep(PAYOUT_FREQUENCY.seconds)
+            watcher.clear()
+            self.maintain_pool()
+            with PHASE_SECONDS.time(phase="cycle"):
+                more_work = self.dowork()
+            if not more_work and watcher.wait(PAYOUT_FREQUENCY.total_seconds()):
+                # give a burst of requests a moment to arrive, so they
+                # end up sharing a transaction
+                time.sleep(BATCH_WINDOW.total_seconds())
+            delay = (self.last_tx + MIN_TX_INTERVAL - utcnow()).total_seconds()
+            if delay > 0:
+                time.sleep(delay)
 
     def dowork(self) -> bool:
         more_work = False
         now = utcnow()
-        current = self.reqs.read()
+        with PHASE_SECONDS.time(phase="scan"):
+            current = self.reqs.read()
+        BACKLOG.set(len(current))
 
         payouts : Dict[str, List[str]] = {}
         rejects : List[str] = []
         bad : List[faucetpayouts.Request] = []
-        good : List[faucetpayouts.Request] = []
+        batches : List[List[faucetpayouts.Request]] = [[]]
+        batch_vsize = 0
         good_addresses : Set[str] = set()
+        good_users : Set[int] = set()
+        with PHASE_SECONDS.time(phase="seen"):
+            seen = self.paid.seen_many(r["filename"] for r in current)
+        self.expire_last_paid(now)
+        todo = []
         for r in current:
-            if len(good) >= MAX_PER_TX:
-                more_work = True
-                break
-            s, tx = self.paid.seen(r["filename"])
-            if s:
+            if r["filename"] in seen:
+                tx = seen[r["filename"]]
                 l = payouts.setdefault(tx, []) if tx else rejects
                 l.append(r["filename"])
-                continue
-            req = faucetpayouts.Request(filename=r["filename"], timestamp=totime(r["timestamp"]), username=r["user_name"], userid=r["user_id"], address=r["address"])
-            lastr, lastp = self.paid.last_payout(r["user_id"])
-            if lastr is not None and lastr.timestamp + REQUEST_FREQUENCY >= now:
-                logging.debug(f"ignoring request to {req.address} for {req.username}; wait longer")
-                bad.append(req)
-                continue
-            if req.address in good_addresses:
-                logging.debug(f"ignoring request for duplicate address {req.address}")
-                bad.append(req)
-                continue
-            logging.info(f"queuing payment to {req.address} for {req.username}")
-            good.append(req)
-            good_addresses.add(req.address)
+            else:
+                todo.append(r)
+
+        # only handle requests from users we hold a lease on, claiming them
+        # a chunk at a time so other workers can take the rest
+        claimed : Set[int] = set()
+        for chunk in faucetpayouts.chunked(todo, CLAIM_CHUNK):
+            with PHASE_SECONDS.time(phase="claim"):
+                got = self.claim(set(r["user_id"] for r in chunk), now)
+                claimed |= got
+                # another worker may have dealt with them since we looked
+                done = self.paid.seen_many(r["filename"] for r in chunk if r["user_id"] in got)
+            for r in chunk:
+                if r["user_id"] not in got or r["filename"] in done:
+                    continue
+                req = faucetpayouts.Request(filename=r["filename"], timestamp=totime(r["timestamp"]), username=r["user_name"], userid=r["user_id"], address=r["address"])
+                lastt = self.last_paid.get(r["user_id"])
+                if (lastt is not None and lastt + REQUEST_FREQUENCY >= now) or req.userid in good_users:
+                    logging.debug(f"ignoring request to {req.address} for {req.username}; wait longer")
+                    bad.append(req)
+                    continue
+                if req.address in good_addresses:
+                    logging.debug(f"ignoring request for duplicate address {req.address}")
+                    bad.append(req)
+                    continue
+                spk = bitcoinaddr.script_pubkey(req.address)
+                if spk is None:
+                    logging.debug(f"ignoring request for invalid address {req.address}")
+                    bad.append(req)
+                    continue
+                # 8 byte amount, 1 byte script length, plus the scriptPubKey
+                vsize = 9 + len(spk)
+                if batch_vsize + vsize > MAX_PAYOUT_VSIZE or len(batches[-1]) >= MAX_PER_TX:
+                    if len(batches) >= MAX_TX_PER_CYCLE:
+                        more_work = True
+                        break
+                    batches.append([])
+                    batch_vsize = 0
+                logging.info(f"queuing payment to {req.address} for {req.username}")
+                batches[-1].append(req)
+                batch_vsize += vsize
+                good_addresses.add(req.address)
+                good_users.add(req.userid)
+            if more_work:
+                break
 
         if bad:
-            self.paid.add_bad_reqs(bad)
+            with PHASE_SECONDS.time(phase="record"):
+                self.paid.add_bad_reqs(bad)
             rejects.extend(b.filename for b in bad)
+            REQUESTS.inc(len(bad), outcome="rejected")
+
+        batches = [b for b in batches if b]
+        if batches:
+            with PHASE_SECONDS.time(phase="payout"):
+                results, failed = self.generate_payouts(batches)
+            self.last_tx = utcnow()
+            for good, payout_txid in results:
+                if payout_txid is not None:
+                    with PHASE_SECONDS.time(phase="record"):
+                        self.paid.add_paid_reqs(now, payout_txid, good)
+                    self.note_paid(good)
+                    payouts[payout_txid] = [g.filename for g in good]
+                    REQUESTS.inc(len(good), outcome="paid")
+                PAYOUTS.inc(result="failed" if payout_txid is None else "sent")
+                logging.info(f"made payout {payout_txid} to {len(good)} requests")
+            if failed:
+                with PHASE_SECONDS.time(phase="record"):
+                    self.paid.add_bad_reqs(failed)
+                rejects.extend(f.filename for f in failed)
+                REQUESTS.inc(len(failed), outcome="rejected")
 
-        if good:
-            payout_txid = self.generate_payout(good)
-            if payout_txid is not None:
-                self.paid.add_paid_reqs(now, payout_txid, good)
-                payouts[payout_txid] = [g.filename for g in good]
-            logging.info(f"made payout {payout_txid}")
+        # everything we paid or rejected is now in audit.sqlite, so other
+        # workers will see it; if we crashed before here, the leases expire
+        self.paid.release_users(WORKER_ID, claimed)
+
+        with PHASE_SECONDS.time(phase="events"):
+            names = set(r["filename"] for r in current)
+            self.journaled = {f: j for f, j in self.journaled.items() if f in names}
+            for txid, filenames in list(payouts.items()) + [(None, rejects)]:
+                filenames = [f for f in filenames if f not in self.journaled or self.journaled[f][0] <= now]
+                if filenames:
+                    self.events.append(now, txid, filenames)
+                    for f in filenames:
+                        wait = min(self.journaled[f][1] * 2, REJOURNAL_MAX) if f in self.journaled else REJOURNAL_AFTER
+                        self.journaled[f] = (now + wait, wait)
 
         status = faucetstatus.Status(
             last_check=now,
@@ -103,41 +265,164 @@ class Worker:
             faucet_address="unknown",
             current_payouts=payouts,
             current_rejects=rejects,
+            btc_per_tx=BTC_PER_TX,
+            btc_per_out=BTC_PER_OUT,
+            outputs_per_tx=OUTPUTS_PER_TX,
         )
-        status.write()
+        with PHASE_SECONDS.time(phase="status"):
+            status.write()
+        metrics.write(METRICS_FILE)
         return more_work
 
-    def generate_payout(self, requests):
-        amount = min(BTC_PER_OUT, (BTC_PER_TX/len(requests)).quantize(QUANTIZE, rounding=decimal.ROUND_DOWN))
-        amount = str(amount)
+    def claim(self, userids : Set[int], now : datetime.datetime) -> Set[int]:
+        claimed, last_paid = self.paid.claim_users(WORKER_ID, userids, now, LEASE_TIME)
+        # audit.sqlite may know of payouts made by other workers
+        for userid in claimed:
+            if userid in last_paid:
+                self.last_paid[userid] = last_paid[userid]
+            else:
+                self.last_paid.pop(userid, None)
+        return claimed
+
+    def expire_last_paid(self, now : datetime.datetime) -> None:
+        cutoff = now - REQUEST_FREQUENCY
+        for userid in [u for u, t in self.last_paid.items() if t < cutoff]:
+            del self.last_paid[userid]
 
-        create_in = '[]\n' + json.dumps([{entry.address: amount} for entry in requests])
+    def note_paid(self, reqs : List[faucetpayouts.Request]) -> None:
+        for r in reqs:
+            t = self.last_paid.get(r.userid)
+            if t is None or r.timestamp > t:
+                self.last_paid[r.userid] = r.timestamp
 
-        proc = subprocess.Popen(f"{CMD} -stdin createrawtransaction", stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True, encoding='utf8')
-        proc.stdin.write(create_in)
-        proc.stdin.close()
-        unfunded = proc.stdout.read()
+    @staticmethod
+    def payout_amount(requests : List[faucetpayouts.Request]) -> str:
+        return str(min(BTC_PER_OUT, (BTC_PER_TX/len(requests)).quantize(QUANTIZE, rounding=decimal.ROUND_DOWN)))
 
-        proc = subprocess.Popen(f"{CMD} -stdin fundrawtransaction", stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True, encoding='utf8')
-        out, errs = proc.communicate(unfunded + '{"include_unsafe": true}\n')
-        if errs:
-             return None
-        funded = json.loads(out)["hex"]
+    def fund_payout(self, rpc : bitcoinrpc.RPC, requests : List[faucetpayouts.Request], amount : Optional[str] = None) -> Union[str, bitcoinrpc.RPCError]:
+        if amount is None:
+            amount = self.payout_amount(requests)
+        outputs = [{entry.address: amount} for entry in requests]
+        try:
+            coin = self.pool.take() if self.pool is not None else None
+            if coin is not None:
+                unfunded = rpc.createrawtransaction([coin], outputs)
+                try:
+                    return rpc.fundrawtransaction(unfunded, {"add_inputs": False, "lock_unspents": True})["hex"]
+                except bitcoinrpc.RPCError as e:
+                    logging.warning(f"could not fund payout from pool coin {coin['txid']}:{coin['vout']}: {e}")
+                    self.pool.put_back([coin])
+            unfunded = rpc.createrawtransaction([], outputs)
+            # lock the chosen coins so that a payout being funded at the
+            # same time can't pick them too
+            return rpc.fundrawtransaction(unfunded, {"include_unsafe": True, "lock_unspents": True})["hex"]
+        except bitcoinrpc.RPCError as e:
+            return e
 
-        proc = subprocess.Popen(f"{CMD} -stdin signrawtransactionwithwallet", stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True, encoding='utf8')
-        out, errs = proc.communicate(funded)
-        signed = json.loads(out)["hex"]
+    def unlock_inputs(self, funded : str) -> None:
+        try:
+            vin = self.rpc.decoderawtransaction(funded)["vin"]
+            self.rpc.lockunspent(True, [{"txid": i["txid"], "vout": i["vout"]} for i in vin])
+        except bitcoinrpc.RPCError as e:
+            logging.warning(f"could not unlock inputs of failed payout: {e}")
+            return
+        if self.pool is not None:
+            self.pool.put_back(vin)
 
-        result = subprocess.run(f"{CMD} -stdin sendrawtransaction", input=signed, shell=True, encoding='utf8', capture_output=True)
+    def send_payout(self, funded : str, test : bool = False) -> Union[str, bitcoinrpc.RPCError]:
+        # with test set, only check whether the payout would be accepted;
+        # returns the txid either way
+        try:
+            signed = self.rpc.signrawtransactionwithwallet(funded)
+            if not signed["complete"]:
+                result = bitcoinrpc.RPCError(None, f"could not sign: {signed.get('errors')}", "signrawtransactionwithwallet")
+            elif test:
+                r = self.rpc.testmempoolaccept([signed["hex"]])[0]
+                result = r["txid"] if r["allowed"] else bitcoinrpc.RPCError(RPC_VERIFY_REJECTED, r.get("reject-reason", ""), "testmempoolaccept")
+            else:
+                result = self.rpc.sendrawtransaction(signed["hex"])
+        except bitcoinrpc.RPCError as e:
+            result = e
+        if not isinstance(result, bitcoinrpc.RPCError) and not self.RE_TXID.match(result):
+            result = bitcoinrpc.RPCError(None, f"unexpected txid {result!r}", "sendrawtransaction")
+        if test or isinstance(result, bitcoinrpc.RPCError):
+            self.unlock_inputs(funded)
+        return result
 
-        txid = result.stdout.strip()
-        if self.RE_TXID.match(txid):
-            return txid
-        else:
+    def try_payout(self, requests : List[faucetpayouts.Request], amount : Optional[str] = None, test : bool = False) -> Union[str, bitcoinrpc.RPCError]:
+        funded = self.fund_payout(self.rpc, requests, amount)
+        if isinstance(funded, bitcoinrpc.RPCError):
+            return funded
+        return self.send_payout(funded, test)
+
+    def generate_payout(self, requests : List[faucetpayouts.Request]) -> Optional[str]:
+        r = self.try_payout(requests)
+        if isinstance(r, bitcoinrpc.RPCError):
+            logging.error(f"payout failed: {r}")
             return None
+        return r
+
+    def find_bad_outputs(self, requests : List[faucetpayouts.Request], amount : str) -> List[faucetpayouts.Request]:
+        # bisect to find which requests stop a payout from being accepted,
+        # checking each half without broadcasting anything
+        r = self.try_payout(requests, amount, test=True)
+        if not isinstance(r, bitcoinrpc.RPCError):
+            return []
+        if not output_error(r):
+            raise r
+        if len(requests) == 1:
+            logging.info(f"payout to {requests[0].address} for {requests[0].username} failed: {r}")
+            return requests
+        mid = len(requests) // 2
+        return self.find_bad_outputs(requests[:mid], amount) + self.find_bad_outputs(requests[mid:], amount)
+
+    def isolate_payout(self, batch : List[faucetpayouts.Request], err : bitcoinrpc.RPCError) -> Tuple[List[Tuple[List[faucetpayouts.Request], Optional[str]]], List[faucetpayouts.Request]]:
+        # one bad output shouldn't stop everyone else being paid: find the
+        # bad ones and pay the rest
+        logging.error(f"payout failed: {err}")
+        if not output_error(err):
+            return [(batch, None)], []
+        try:
+            bad = self.find_bad_outputs(batch, self.payout_amount(batch))
+        except bitcoinrpc.RPCError as e:
+            logging.error(f"could not isolate failing outputs: {e}")
+            return [(batch, None)], []
+        bad_ids = {id(r) for r in bad}
+        rest = [r for r in batch if id(r) not in bad_ids]
+        if not bad or not rest:
+            return [(rest, None)] if rest else [], bad
+        return [(rest, self.generate_payout(rest))], bad
+
+    def generate_payouts(self, batches : List[List[faucetpayouts.Request]]) -> Tuple[List[Tuple[List[faucetpayouts.Request], Optional[str]]], List[faucetpayouts.Request]]:
+        # Fund the next payout in a background thread while the current
+        # one is signed and sent. If there weren't enough spare coins to
+        # fund it in parallel, try again once the current one is in the
+        # mempool, when its change can be spent.
+        # Returns each batch paid (txid None if it failed), and any
+        # requests that were found to be unpayable.
+        results : List[Tuple[List[faucetpayouts.Request], Optional[str]]] = []
+        failed : List[faucetpayouts.Request] = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+            funding = pool.submit(self.fund_payout, self.fund_rpc, batches[0])
+            for i, batch in enumerate(batches):
+                funded = funding.result()
+                if isinstance(funded, bitcoinrpc.RPCError) and funded.code == RPC_WALLET_INSUFFICIENT_FUNDS and i > 0:
+                    funded = self.fund_payout(self.rpc, batch)
+                if i + 1 < len(batches):
+                    funding = pool.submit(self.fund_payout, self.fund_rpc, batches[i + 1])
+                r = funded if isinstance(funded, bitcoinrpc.RPCError) else self.send_payout(funded)
+                if isinstance(r, bitcoinrpc.RPCError):
+                    paid, bad = self.isolate_payout(batch, r)
+                    results.extend(paid)
+                    failed.extend(bad)
+                else:
+                    results.append((batch, r))
+        return results, failed
 
 def main():
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    if METRICS_FILE:
+        metrics.enable()
     worker = Worker()
     worker.loop()
 
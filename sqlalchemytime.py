@@ -18,3 +18,25 @@ class TimeStamp(sa.types.TypeDecorator):
             return value.replace(tzinfo=datetime.timezone.utc)
 
         return value.astimezone(datetime.timezone.utc)
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+class IntTimeStamp(sa.types.TypeDecorator):
+    # microseconds since the epoch, UTC, as an INTEGER: smaller than
+    # TimeStamp's text, and compared without parsing
+    cache_ok = True
+    impl = sa.types.BigInteger
+
+    def process_bind_param(self, value: datetime.datetime, dialect):
+        if value is None: return None
+        return (value.astimezone(datetime.timezone.utc) - EPOCH) // MICROSECOND
+
+    def process_result_value(self, value, dialect):
+        if value is None: return None
+        return EPOCH + datetime.timedelta(microseconds=value)
+
+def to_epoch_us(conn : sa.engine.Connection, table : str, column : str) -> None:
+    # convert a column of TimeStamp's text ("YYYY-MM-DD HH:MM:SS.ffffff",
+    # UTC) in place to IntTimeStamp's integers, for a migration
+    conn.exec_driver_sql(f"UPDATE {table} SET {column} = CAST(strftime('%s', {column}) AS INTEGER) * 1000000 + CAST(substr({column} || '.000000', 21, 6) AS INTEGER) WHERE typeof({column}) = 'text'")
@@ -10,6 +10,16 @@ def utcnow():
     return datetime.datetime.now(datetime.timezone.utc)
 
 def totime(s : str) -> datetime.datetime:
+    # TIME_FMT by hand, as strptime is slow; anything that isn't exactly
+    # what fromtime() writes goes to strptime to be parsed or rejected
+    if len(s) == 22 and s[8] == "-" and s[15] == "." and s.isascii():
+        ymd, hms, us = s[:8], s[9:15], s[16:]
+        if ymd.isdigit() and hms.isdigit() and us.isdigit():
+            ymd, hms = int(ymd), int(hms)
+            return datetime.datetime(ymd // 10000, ymd // 100 % 100, ymd % 100, hms // 10000, hms // 100 % 100, hms % 100, int(us), datetime.timezone.utc)
+    return strptime(s)
+
+def strptime(s : str) -> datetime.datetime:
     return datetime.datetime.strptime(s, TIME_FMT).replace(tzinfo=datetime.timezone.utc)
 
 def fromtime(dt : datetime.datetime) -> str:
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+
+import time
+
+class TokenBucket:
+    # Allows bursts of up to capacity, refilling at rate tokens per
+    # second. Not thread safe; the bot only uses it from the event loop.
+    def __init__(self, rate : float, capacity : float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+
+    def take(self, n : float = 1) -> bool:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens < n:
+            return False
+        self._tokens -= n
+        return True
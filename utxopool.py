@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Keeps a pool of confirmed coins of one size in the faucet's wallet, so
+# that each payout can be funded from a single known input instead of
+# leaving coin selection to sort through every bit of unconfirmed change,
+# and never has unconfirmed ancestors. Splits off more coins when the pool
+# runs low, and merges the wallet's other coins when there are too many.
+
+from typing import List, Optional, Set, Tuple
+
+import decimal
+import logging
+import threading
+
+import bitcoinrpc
+
+# merge the wallet's other confirmed coins once there are more than this
+CONSOLIDATE_OVER = 50
+# inputs spent by one consolidation
+CONSOLIDATE_MAX = 200
+
+class UTXOPool:
+    def __init__(self, rpc : bitcoinrpc.RPC, target : int, coin : decimal.Decimal):
+        self.rpc = rpc
+        self.target = target
+        self.coin = coin
+        self.balance = decimal.Decimal(0)
+        self._coins : List[dict] = []   # {txid, vout} of confirmed pool coins
+        self._pending = 0               # pool coins still waiting to confirm
+        self._other : List[dict] = []   # listunspent entries for other confirmed coins
+        self._taken : Set[Tuple[str, int]] = set()  # pool coins taken since the last refresh
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._coins)
+
+    def refresh(self) -> None:
+        # also works out the wallet balance, the same way getbalance does
+        coins, other, pending = [], [], 0
+        balance = decimal.Decimal(0)
+        for u in self.rpc.listunspent(0):
+            if not u.get("spendable", True):
+                continue
+            if u["safe"]:
+                balance += u["amount"]
+            if u["amount"] == self.coin:
+                if u["confirmations"] > 0:
+                    coins.append(dict(txid=u["txid"], vout=u["vout"]))
+                else:
+                    pending += 1
+            elif u["confirmations"] > 0:
+                other.append(u)
+        with self._lock:
+            self._coins, self._other, self._pending = coins, other, pending
+            self._taken = set()
+            self.balance = balance
+
+    def take(self) -> Optional[dict]:
+        # a pool coin to spend, or None if the pool is empty
+        with self._lock:
+            if not self._coins:
+                return None
+            coin = self._coins.pop()
+            self._taken.add((coin["txid"], coin["vout"]))
+            return coin
+
+    def put_back(self, inputs : List[dict]) -> None:
+        # the inputs of a transaction that was funded but never sent; any
+        # pool coins among them can be used again
+        with self._lock:
+            for i in inputs:
+                k = (i["txid"], i["vout"])
+                if k in self._taken:
+                    self._taken.discard(k)
+                    self._coins.append(dict(txid=i["txid"], vout=i["vout"]))
+
+    def maintain(self) -> Optional[str]:
+        # at most one transaction per call; returns its txid
+        self.refresh()
+        want = self.target - len(self._coins) - self._pending
+        if want > 0:
+            return self._split(want)
+        if len(self._other) > CONSOLIDATE_OVER:
+            return self._consolidate()
+        return None
+
+    def _send(self, unfunded : str, options : dict) -> str:
+        funded = self.rpc.fundrawtransaction(unfunded, dict(options, add_inputs=False, lock_unspents=True))["hex"]
+        try:
+            signed = self.rpc.signrawtransactionwithwallet(funded)
+            if not signed["complete"]:
+                raise bitcoinrpc.RPCError(None, f"could not sign: {signed.get('errors')}", "signrawtransactionwithwallet")
+            return self.rpc.sendrawtransaction(signed["hex"])
+        except bitcoinrpc.RPCError:
+            vin = self.rpc.decoderawtransaction(funded)["vin"]
+            self.rpc.lockunspent(True, [{"txid": i["txid"], "vout": i["vout"]} for i in vin])
+            raise
+
+    def _split(self, n : int) -> Optional[str]:
+        # spend the largest other coins, leaving a coin's worth for fees
+        # and change
+        inputs, total = [], decimal.Decimal(0)
+        for u in sorted(self._other, key=lambda u: u["amount"], reverse=True):
+            if total >= (n + 1) * self.coin:
+                break
+            inputs.append(u)
+            total += u["amount"]
+        n = min(n, int(total / self.coin) - 1)
+        if n <= 0:
+            logging.warning("not enough confirmed funds to add to the utxo pool")
+            return None
+        addresses = self.rpc.batch([("getnewaddress",)] * n)
+        for a in addresses:
+            if isinstance(a, bitcoinrpc.RPCError):
+                raise a
+        unfunded = self.rpc.createrawtransaction([dict(txid=u["txid"], vout=u["vout"]) for u in inputs], [{a: str(self.coin)} for a in addresses])
+        txid = self._send(unfunded, {})
+        logging.info(f"split {len(inputs)} coins into {n} pool coins in {txid}")
+        return txid
+
+    def _consolidate(self) -> str:
+        inputs = sorted(self._other, key=lambda u: u["amount"])[:CONSOLIDATE_MAX]
+        total = sum((u["amount"] for u in inputs), decimal.Decimal(0))
+        address = self.rpc.getnewaddress()
+        unfunded = self.rpc.createrawtransaction([dict(txid=u["txid"], vout=u["vout"]) for u in inputs], [{address: str(total)}])
+        txid = self._send(unfunded, {"subtractFeeFromOutputs": [0]})
+        logging.info(f"consolidated {len(inputs)} coins in {txid}")
+        return txid